@@ -1,44 +1,100 @@
+import time
+# Отметка начала загрузки модуля — отсчёт для замера холодного старта
+STARTUP_STARTED = time.perf_counter()
+
 import os
+import sys
 import platform
 import logging
+import struct
+import mmap
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 from datetime import datetime, date, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from array import array
+from operator import mul
+from itertools import accumulate
 import glob
+import bisect
+import heapq
+import itertools
+import shutil
+import csv
+import gzip
+import tempfile
+import re
+import hmac
+import signal
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import (Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler,
+                          CallbackQueryHandler, ContextTypes)
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
 import asyncio
 import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+# внешний пакет для локализации дат загружается при первом форматировании,
+# а не при импорте: данные локали babel не нужны до первого ответа
+_babel_dates = None
+
+
+def _load_babel():
+    """Модуль babel.dates или False, если пакет не установлен"""
+    global _babel_dates
+    if _babel_dates is None:
+        try:
+            from babel import dates
+        except ImportError:
+            dates = False
+        _babel_dates = dates
+    return _babel_dates
+
+
+def format_date(dt, format, locale):
+    babel_dates = _load_babel()
+    if babel_dates:
+        return babel_dates.format_date(dt, format, locale=locale)
+    # Заглушка для случая отсутствия внешних зависимостей
+    return dt.strftime('%d.%m.%Y')
+
+
+def format_datetime(dt, format, locale):
+    babel_dates = _load_babel()
+    if babel_dates:
+        return babel_dates.format_datetime(dt, format, locale=locale)
+    return dt.strftime('%d.%m.%Y %H:%M:%S')
 
-# внешний пакет для красивого логгирования и локализации дат
-try:
-    import coloredlogs
-    from babel.dates import format_date, format_datetime
-    HAS_EXTERNAL_DEPS = True
-except ImportError:
-    HAS_EXTERNAL_DEPS = False
-    # Заглушки для случая отсутствия внешних зависимостей
-    def format_date(dt, format, locale):
-        return dt.strftime('%d.%m.%Y')
-    
-    def format_datetime(dt, format, locale):
-        return dt.strftime('%d.%m.%Y %H:%M:%S')
 
 # ============================================
 # Настройка логирования (цветной)
 # ============================================
 logger = logging.getLogger(__name__)
-if HAS_EXTERNAL_DEPS:
+
+
+def setup_logging() -> None:
+    """Настройка логирования при запуске бота (coloredlogs — если установлен)"""
+    try:
+        import coloredlogs
+    except ImportError:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        return
     coloredlogs.install(
         level="INFO",
         logger=logger,
         fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
-else:
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
 
 # === КОНФИГУРАЦИЯ ===
 # Токен берём из переменных окружения — безопаснее, чем хардкодить.
@@ -80,6 +136,7 @@ TARIFFS = {
     },
     'yandex_x5': {
         'name': '🛒 Яндекс Подписка X5',
+        'button': '🛒 Яндекс X5',  # подпись кнопки главного меню, если короче названия
         'submenu': {
             'yandex_x5_new': 'Новый клиент',
             'yandex_x5_returning': 'Вернувшийся клиент',
@@ -88,6 +145,7 @@ TARIFFS = {
     },
     'yandex_kids': {
         'name': '👶 Яндекс Подписка Детям',
+        'button': '👶 Яндекс Детям',
         'submenu': {
             'yandex_kids_new': 'Новый клиент',
             'yandex_kids_returning': 'Вернувшийся клиент',
@@ -113,12 +171,3065 @@ PRICE_MAP = {
     'yandex_kids_active': 50
 }
 
+# Читаемые названия тарифов для статистики и отчётов
+TARIFF_DISPLAY_NAMES = {
+    'mts_real_1month': '📱 МТС Риил (1 Месяц)',
+    'mts_real_subscription': '📱 МТС Риил (Абонемент)',
+    'mts_real': '📱 МТС Риил',
+    'mts_more_1month': '📶 МТС Больше (1 Месяц)',
+    'mts_more_subscription': '📶 МТС Больше (Абонемент)',
+    'mts_more': '📶 МТС Больше',
+    'mts_super': '⚡ МТС Супер',
+    'membrane': '🛡️ Мембрана',
+    'yandex_search': '🔍 Яндекс Поиск',
+    'yandex_x5_new': '🛒 Яндекс Подписка X5 (Новый)',
+    'yandex_x5_returning': '🛒 Яндекс Подписка X5 (Вернувшийся)',
+    'yandex_x5_active': '🛒 Яндекс Подписка X5 (Действующий)',
+    'yandex_x5': '🛒 Яндекс Подписка X5',
+    'yandex_kids_new': '👶 Яндекс Подписка Детям (Новый)',
+    'yandex_kids_returning': '👶 Яндекс Подписка Детям (Вернувшийся)',
+    'yandex_kids_active': '👶 Яндекс Подписка Детям (Действующий)',
+    'yandex_kids': '👶 Яндекс Подписка Детям'
+}
+
+# Размер ячейки счётчика (uint32) в array('I')
+COUNTER_ITEMSIZE = array('I').itemsize
+
+# Журнал событий продаж — источник истины для дневной и месячной статистики
+EVENTS_DIR = 'data/events'
+
+# Хранилище статистики: 'json' (журнал + JSON файлы), 'sqlite' или 'mmap'
+# (журнал + отображённая в память матрица счётчиков на месяц)
+STORAGE_BACKEND = 'json'
+SQLITE_PATH = 'data/sales.db'
+MATRIX_DIR = 'data/matrix'
+# Начальная ёмкость матрицы месяца; при нехватке файл пересобирается вдвое больше
+MATRIX_MIN_USERS = 32
+MATRIX_MIN_TARIFFS = 32
+
+# Потоки для файлового ввода-вывода, чтобы не блокировать цикл событий
+IO_WORKERS = 4
+
+# Групповая фиксация продаж: окно сбора (сек) и fsync после записи файлов
+GROUP_COMMIT_WINDOW = 0.05
+FSYNC_WRITES = False
+
+# Отложенная запись агрегатов: период сброса (сек) и порог накопленных изменений
+FLUSH_INTERVAL = 5.0
+FLUSH_DIRTY_THRESHOLD = 50
+
+# Постоянные сессии пользователей (переживают перезапуск бота)
+SESSIONS_DIR = 'data/sessions'
+
+# Файл блокировки каталога данных: хранилища и кэши рассчитаны на один процесс,
+# второй экземпляр бота на том же data/ не запускается
+INSTANCE_LOCK = 'data/.instance.lock'
+
+# Версия формата файлов статистики: каталог с меткой этой версии при запуске
+# не сканируется. Увеличить при изменении ключей, требующем миграции файлов
+DATA_SCHEMA_VERSION = 1
+SCHEMA_MARKER = '.schema_version'
+# Процессы для миграции файлов статистики
+MIGRATION_WORKERS = 2
+
+# Кэш готовых экранов статистики и посчитанных итогов периодов (размеры LRU)
+RENDER_CACHE_SIZE = 256
+TOTALS_CACHE_SIZE = 64
+
+# Отчёт за произвольный диапазон дней (/range): наибольшая длина диапазона (дней)
+RANGE_MAX_DAYS = 366
+
+# Экспорт продаж файлом: каталог временных файлов и форматы ('.gz' — со сжатием gzip)
+EXPORT_DIR = 'data/exports'
+EXPORT_FORMATS = ('csv', 'csv.gz', 'jsonl', 'jsonl.gz')
+# Фоновые задачи экспорта: одновременно выполняемые задачи и период обновления прогресса (сек)
+EXPORT_WORKERS = 2
+EXPORT_PROGRESS_INTERVAL = 3.0
+
+# Параллельная обработка обновлений: сколько обновлений разных пользователей
+# обрабатывается одновременно (обновления одного пользователя — всегда по очереди)
+UPDATE_CONCURRENCY = 16
+
+# Исходящие запросы к Telegram: общий лимит (запросов/сек), лимит на чат с запасом
+# всплеска и число повторов после RetryAfter. Приоритет передаётся через rate_limit_args
+OUTBOUND_GLOBAL_RATE = 30.0
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_MAX_RETRIES = 3
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Рейтинг (/top): сколько мест показывать
+LEADERBOARD_SIZE = 10
+
+# Приём обновлений: 'polling' (опрос getUpdates) или 'webhook' (встроенный HTTP сервер)
+UPDATE_MODE = 'polling'
+# Вебхук: адрес и порт прослушивания, путь запроса и секрет из заголовка
+# X-Telegram-Bot-Api-Secret-Token. Без секрета режим вебхука не запускается:
+# роли определяются по username из обновления, и поддельный запрос на открытый
+# порт иначе выполнил бы действия руководителя. Секрет — 1–256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET = ''
+# Публичный адрес вебхука для setWebhook. Пустой — вебхук не регистрируется
+# (зарегистрирован заранее, например на адрес обратного прокси, либо локальная проверка)
+WEBHOOK_URL = ''
+# Наибольший размер тела запроса (байт) и время ожидания заголовков и тела (сек)
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_READ_TIMEOUT = 10.0
+
+# Бюджет холодного старта (мс) для python BRBDSA.py --benchmark-startup
+STARTUP_BUDGET_MS = 2000
+
+
+# ============================================
+# Журнал событий (append-only)
+# ============================================
+class SaleEventLog:
+    """Append-only журнал событий продаж: один файл JSON Lines на день.
+
+    Каждая продажа — одна дописанная строка. Файлы data/daily и data/monthly
+    больше не правятся на каждое нажатие, а пересобираются из журнала.
+    """
+
+    def __init__(self, directory: str = EVENTS_DIR):
+        self.directory = directory
+
+    def path_for(self, day: date) -> str:
+        return os.path.join(self.directory, f'events_{day.isoformat()}.jsonl')
+
+    def append(self, day: date, events: list) -> int:
+        """Дописать события в журнал дня одной записью; возвращает размер журнала (байт)"""
+        lines = ''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in events)
+        with open(self.path_for(day), 'ab') as f:
+            f.write(lines.encode('utf-8'))
+            if FSYNC_WRITES:
+                f.flush()
+                os.fsync(f.fileno())
+            return f.tell()
+
+    def read(self, day: date) -> list:
+        """Прочитать все события дня (битая последняя строка после сбоя пропускается)"""
+        events = []
+        path = self.path_for(day)
+        if not os.path.exists(path):
+            return events
+
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Пропущена повреждённая запись журнала в {path}")
+        return events
+
+    def days(self) -> list:
+        """Дни, для которых есть журнал (по возрастанию)"""
+        days = []
+        for file_path in glob.glob(os.path.join(self.directory, 'events_*.jsonl')):
+            filename = os.path.basename(file_path)
+            try:
+                days.append(datetime.strptime(filename[7:-6], '%Y-%m-%d').date())
+            except ValueError:
+                continue
+        return sorted(days)
+
+    def days_in_month(self, month_str: str) -> list:
+        """Дни месяца (YYYY-MM), для которых есть журнал"""
+        return [day for day in self.days() if day.strftime('%Y-%m') == month_str]
+
+    def size(self, days: list) -> int:
+        """Суммарный размер журналов указанных дней (байт)"""
+        return sum(os.path.getsize(self.path_for(day)) for day in days
+                   if os.path.exists(self.path_for(day)))
+
+    def last_modified(self, days: list) -> int:
+        """Время последнего изменения журналов указанных дней (ns)"""
+        mtimes = [os.stat(self.path_for(day)).st_mtime_ns for day in days
+                  if os.path.exists(self.path_for(day))]
+        return max(mtimes, default=0)
+
+
+def month_bounds(month_str: str) -> tuple:
+    """Первый и последний день месяца YYYY-MM"""
+    start = date.fromisoformat(f'{month_str}-01')
+    end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return start, end
+
+
+def range_period(start: date, end: date) -> str:
+    """Ключ диапазона дней 'YYYY-MM-DD..YYYY-MM-DD' (наравне с днём и месяцем)"""
+    return f'{start.isoformat()}..{end.isoformat()}'
+
+
+def months_between(start: date, end: date) -> list:
+    """Месяцы 'YYYY-MM', задетые днями start..end"""
+    months = []
+    month = start.replace(day=1)
+    while month <= end:
+        months.append(month.strftime('%Y-%m'))
+        month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return months
+
+
+def range_presets(today: date) -> list:
+    """Готовые периоды для выбора: (название, первый день, последний день)"""
+    month_start = today.replace(day=1)
+    previous_month_end = month_start - timedelta(days=1)
+    quarter_start = today.replace(month=(today.month - 1) // 3 * 3 + 1, day=1)
+    return [
+        ("📅 Последние 7 дней", today - timedelta(days=6), today),
+        ("📅 Последние 30 дней", today - timedelta(days=29), today),
+        ("📆 С начала месяца", month_start, today),
+        ("📆 Прошлый месяц", previous_month_end.replace(day=1), previous_month_end),
+        ("📊 С начала квартала", quarter_start, today),
+        ("📈 С начала года", today.replace(month=1, day=1), today),
+    ]
+
+
+def event_day(event: dict) -> date:
+    """День, к которому относится событие (сброс может адресовать прошлый день)"""
+    return date.fromisoformat(event.get('day') or event['ts'][:10])
+
+
+class DataDirLocked(Exception):
+    """Каталог данных занят другим экземпляром бота"""
+
+
+def acquire_instance_lock(path: str = INSTANCE_LOCK):
+    """Исключительная блокировка каталога данных на время работы процесса.
+
+    Журнал, агрегаты в памяти и кэши не видят записей другого процесса,
+    поэтому второй экземпляр на тех же данных не запускается (DataDirLocked).
+    Блокировка снимается закрытием возвращённого файла или завершением процесса.
+    """
+    handle = open(path, 'a+')
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        handle.close()
+        raise DataDirLocked(f"Каталог данных уже используется другим экземпляром бота ({path})")
+    return handle
+
+
+def write_file_atomic(filename: str, payload: bytes) -> None:
+    """Запись во временный файл с подменой основного через os.replace,
+    так что сбой посреди записи не оставит обрезанный файл"""
+    tmp_path = f"{filename}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        if FSYNC_WRITES:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, filename)
+
+
+def write_stats_file(filename: str, data: dict) -> None:
+    """Атомарно записать агрегат в файл (пустой агрегат — файл удаляется)"""
+    if not data:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    write_file_atomic(filename, json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
+
+
+def read_schema_version(directory: str) -> int:
+    """Версия формата файлов каталога по его метке (0 — метки нет)"""
+    try:
+        with open(os.path.join(directory, SCHEMA_MARKER), 'r', encoding='utf-8') as f:
+            return int(json.load(f).get('version', 0))
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def write_schema_version(directory: str, version: int = DATA_SCHEMA_VERSION) -> None:
+    marker = {'version': version, 'migrated': datetime.now().isoformat(timespec='seconds')}
+    write_file_atomic(os.path.join(directory, SCHEMA_MARKER), json.dumps(marker).encode('utf-8'))
+
+
+# ============================================
+# Справочник тарифов
+# ============================================
+class TariffCatalog:
+    """Таблицы поиска по тарифам, собранные один раз из конфигурации.
+
+    Нормализация ключа, читаемое название, цена, старые ключи вида
+    "тариф_человеческое_название" и проверка callback-данных — поиск в словаре.
+    """
+
+    def __init__(self, tariffs: dict, price_map: dict, display_names: dict):
+        self.tariffs = dict(tariffs)
+        self.prices = dict(price_map)
+        self.known_keys = set(tariffs)
+        # Ключи, нажатие которых записывает продажу: подтарифы и тарифы без подменю
+        self.recordable = set()
+        # Старые ключи -> ключ подтарифа (точные и без учёта регистра)
+        self.aliases = {}
+        self._folded_aliases = {}
+        self.display_names = {}
+
+        for tariff_key, tariff_info in tariffs.items():
+            submenu = tariff_info.get('submenu') or {}
+            self.display_names[tariff_key] = tariff_info.get('name', tariff_key)
+            if not submenu:
+                self.recordable.add(tariff_key)
+            for sub_key, human_name in submenu.items():
+                self.known_keys.add(sub_key)
+                self.recordable.add(sub_key)
+                self.display_names[sub_key] = f"{tariff_info.get('name', tariff_key)} ({human_name})"
+                for name in (human_name, human_name.strip()):
+                    self.aliases[f"{tariff_key}_{name}"] = sub_key
+                self._folded_aliases[f"{tariff_key}_{human_name.strip()}".casefold()] = sub_key
+        self.display_names.update(display_names)
+
+        # Результаты для уже встречавшихся произвольных ключей (ключи из старых файлов)
+        self._normalized = {key: key for key in self.known_keys}
+        self._normalized.update(self.aliases)
+        self._display = {}
+
+    def normalize(self, key: str) -> str:
+        """Ключ подтарифа/тарифа для известных и старых ключей, иначе сам ключ"""
+        normalized = self._normalized.get(key)
+        if normalized is None:
+            tariff_key, _, suffix = key.partition('_')
+            normalized = self.aliases.get(f"{tariff_key}_{suffix.strip()}", key) if suffix else key
+            self._normalized[key] = normalized
+        return normalized
+
+    def display_name(self, key: str) -> str:
+        name = self._display.get(key)
+        if name is None:
+            normalized = self.normalize(key)
+            name = self.display_names.get(normalized, normalized)
+            self._display[key] = name
+        return name
+
+    def price(self, key: str) -> int:
+        return self.prices.get(key, 0)
+
+    def legacy_key(self, key: str) -> str | None:
+        """Подтариф для старого ключа "тариф_название" без учёта регистра"""
+        return self._folded_aliases.get(key.strip().casefold())
+
+    def is_recordable(self, key: str) -> bool:
+        return key in self.recordable
+
+
+TARIFF_CATALOG = TariffCatalog(TARIFFS, PRICE_MAP, TARIFF_DISPLAY_NAMES)
+
+
+# ============================================
+# Компактные счётчики по индексу тарифа
+# ============================================
+class TariffIndex:
+    """Интернирование ключей тарифов в маленькие целые.
+
+    Порядок задаётся TARIFFS (подтарифы вместо родителя) и PRICE_MAP;
+    незнакомые ключи из старых файлов дописываются в конец с ценой 0.
+    """
+
+    def __init__(self, keys: list, price_map: dict):
+        self.keys = []
+        self.positions = {}
+        self.prices = array('I')
+        for key in keys:
+            self.intern(key, price_map.get(key, 0))
+
+    @classmethod
+    def build(cls, tariffs: dict, price_map: dict) -> 'TariffIndex':
+        keys = []
+        for tariff_key, tariff_info in tariffs.items():
+            keys.extend(tariff_info.get('submenu') or [tariff_key])
+        keys.extend(key for key in price_map if key not in keys)
+        keys.extend(key for key in tariffs if key not in keys)
+        return cls(keys, price_map)
+
+    def extend(self, keys: list, price_map: dict) -> None:
+        """Дописать новые ключи и обновить цены (позиции существующих не меняются)"""
+        for key in keys:
+            self.intern(key)
+        for key, position in self.positions.items():
+            self.prices[position] = price_map.get(key, 0)
+
+    def intern(self, key: str, price: int = 0) -> int:
+        position = self.positions.get(key)
+        if position is None:
+            position = len(self.keys)
+            self.keys.append(key)
+            self.positions[key] = position
+            self.prices.append(price)
+        return position
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+TARIFF_INDEX = TariffIndex.build(TARIFFS, PRICE_MAP)
+
+
+def reload_tariff_catalog() -> None:
+    """Пересобрать справочник и индекс тарифов после изменения TARIFFS/PRICE_MAP"""
+    global TARIFF_CATALOG
+    TARIFF_CATALOG = TariffCatalog(TARIFFS, PRICE_MAP, TARIFF_DISPLAY_NAMES)
+    TARIFF_INDEX.extend(TariffIndex.build(TARIFFS, PRICE_MAP).keys, PRICE_MAP)
+
+
+class CounterTable:
+    """Счётчики продаж одного периода: на пользователя — вектор array('I') по индексу тарифа.
+
+    Итог пользователя — сумма вектора, доход — скалярное произведение на вектор цен.
+    Для хранилищ отдаётся прежний формат data/daily|monthly (to_stats), а на диск
+    рядом с JSON пишется компактная бинарная форма (to_bytes).
+    """
+
+    MAGIC = b'BRBC'
+    VERSION = 2
+
+    def __init__(self, index: TariffIndex | None = None):
+        self.index = index or TARIFF_INDEX
+        self.counts = {}    # user_str -> array('I')
+        self.profiles = {}  # user_str -> (username, full_name)
+        # Сколько байт журнала учтено в счётчиках (None — неизвестно)
+        self.log_offset = None
+
+    def _row(self, user_str: str, username: str = '', full_name: str = '') -> array:
+        row = self.counts.get(user_str)
+        if row is None:
+            row = array('I', bytes(COUNTER_ITEMSIZE * len(self.index)))
+            self.counts[user_str] = row
+            self.profiles[user_str] = (username, full_name)
+        elif len(row) < len(self.index):
+            row.frombytes(bytes(COUNTER_ITEMSIZE * (len(self.index) - len(row))))
+        return row
+
+    def add(self, user_str: str, tariff_key: str, count: int = 1,
+            username: str = '', full_name: str = '') -> None:
+        position = self.index.intern(tariff_key)
+        self._row(user_str, username, full_name)[position] += count
+
+    def add_stats(self, data: dict) -> 'CounterTable':
+        """Прибавить агрегат в формате data/daily|monthly"""
+        for user_str, user_data in data.items():
+            row = self._row(user_str, user_data.get('username', ''), user_data.get('full_name', ''))
+            for tariff_key, count in user_data.get('sales', {}).items():
+                position = self.index.intern(tariff_key)
+                if position >= len(row):
+                    row = self._row(user_str)
+                row[position] += count
+        return self
+
+    def merge(self, other: 'CounterTable') -> 'CounterTable':
+        for user_str, other_row in other.counts.items():
+            row = self._row(user_str, *other.profiles[user_str])
+            for position, count in enumerate(other_row):
+                if count:
+                    row[position] += count
+        return self
+
+    def reset(self, user_str: str | None = None) -> None:
+        """Сброс всех (None) или одного пользователя (строка остаётся с нулями)"""
+        if user_str is None:
+            self.counts.clear()
+            self.profiles.clear()
+        elif user_str in self.counts:
+            self.counts[user_str] = array('I', bytes(COUNTER_ITEMSIZE * len(self.index)))
+
+    def apply(self, event: dict) -> None:
+        """Применить событие дневного уровня (продажа, импорт дня, сброс дня)"""
+        kind = event.get('type')
+        if kind == 'sale':
+            self.add(str(event['user_id']), event['tariff'], 1,
+                     event.get('username', ''), event.get('full_name', ''))
+        elif event.get('scope') != 'day':
+            return
+        elif kind == 'import':
+            self.add_stats(event.get('data', {}))
+        elif kind == 'reset':
+            self.reset(None if event.get('user_id') is None else str(event['user_id']))
+
+    def copy(self) -> 'CounterTable':
+        table = CounterTable(self.index)
+        table.counts = {user_str: array('I', row) for user_str, row in self.counts.items()}
+        table.profiles = dict(self.profiles)
+        table.log_offset = self.log_offset
+        return table
+
+    def total(self, user_str: str) -> int:
+        return sum(self.counts[user_str])
+
+    def revenue(self, user_str: str) -> int:
+        return sum(map(mul, self.counts[user_str], self.index.prices))
+
+    def to_stats(self) -> dict:
+        """Прежний формат data/daily|monthly"""
+        keys = self.index.keys
+        data = {}
+        for user_str, row in self.counts.items():
+            username, full_name = self.profiles[user_str]
+            data[user_str] = {
+                'username': username,
+                'full_name': full_name,
+                'sales': {keys[position]: count for position, count in enumerate(row) if count}
+            }
+        return data
+
+    @classmethod
+    def from_stats(cls, data: dict) -> 'CounterTable':
+        return cls().add_stats(data)
+
+    def to_bytes(self) -> bytes:
+        """Колоночная бинарная форма: заголовок (с учтённой длиной журнала, -1 — неизвестна),
+        ключи тарифов, профили, матрица uint32 LE"""
+        def pack_str(value: str) -> bytes:
+            encoded = (value or '').encode('utf-8')
+            return struct.pack('<H', len(encoded)) + encoded
+
+        width = len(self.index)
+        log_offset = -1 if self.log_offset is None else self.log_offset
+        parts = [self.MAGIC, struct.pack('<HHIq', self.VERSION, width, len(self.counts), log_offset)]
+        parts.extend(pack_str(key) for key in self.index.keys)
+        matrix = array('I')
+        for user_str, row in self.counts.items():
+            username, full_name = self.profiles[user_str]
+            parts.append(pack_str(user_str) + pack_str(username) + pack_str(full_name))
+            matrix.extend(row)
+            matrix.frombytes(bytes(COUNTER_ITEMSIZE * (width - len(row))))
+        if sys.byteorder != 'little':
+            matrix.byteswap()
+        parts.append(matrix.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> 'CounterTable':
+        if blob[:4] != cls.MAGIC:
+            raise ValueError("Неверный формат бинарных счётчиков")
+        version, width, user_count = struct.unpack_from('<HHI', blob, 4)
+        log_offset = -1
+        if version == 1:
+            offset = 12
+        elif version == cls.VERSION:
+            (log_offset,) = struct.unpack_from('<q', blob, 12)
+            offset = 20
+        else:
+            raise ValueError(f"Неподдерживаемая версия счётчиков: {version}")
+
+        def unpack_str() -> str:
+            nonlocal offset
+            (length,) = struct.unpack_from('<H', blob, offset)
+            value = blob[offset + 2:offset + 2 + length].decode('utf-8')
+            offset += 2 + length
+            return value
+
+        table = cls()
+        table.log_offset = None if log_offset < 0 else log_offset
+        positions = [table.index.intern(unpack_str()) for _ in range(width)]
+        users = [(unpack_str(), unpack_str(), unpack_str()) for _ in range(user_count)]
+        matrix = array('I')
+        matrix.frombytes(blob[offset:offset + COUNTER_ITEMSIZE * width * user_count])
+        if sys.byteorder != 'little':
+            matrix.byteswap()
+
+        for number, (user_str, username, full_name) in enumerate(users):
+            row = table._row(user_str, username, full_name)
+            for column, position in enumerate(positions):
+                row[position] += matrix[number * width + column]
+        return table
+
+
+# ============================================
+# Хранилища статистики
+# ============================================
+class SalesStorage:
+    """Интерфейс хранилища статистики продаж.
+
+    Агрегаты возвращаются в прежнем формате data/daily|monthly:
+    {user_id_str: {'username', 'full_name', 'sales': {tariff_key: count}}}.
+    """
+
+    # Нужна ли отложенная запись агрегатов из AggregateStore
+    write_behind = False
+
+    def bootstrap(self) -> None:
+        """Подготовка хранилища при запуске"""
+
+    def append(self, event: dict) -> None:
+        """Записать событие (продажа, сброс, импорт)"""
+        self.append_many([event])
+
+    def append_many(self, events: list) -> None:
+        """Записать пачку событий одной фиксацией"""
+        raise NotImplementedError
+
+    def log_position(self, day: date) -> int | None:
+        """Размер журнала дня после последней записи (None — неизвестен или журнала нет)"""
+        return None
+
+    def load_day(self, day: date) -> dict:
+        raise NotImplementedError
+
+    def load_month(self, month_str: str) -> dict:
+        raise NotImplementedError
+
+    def load_range(self, start: date, end: date) -> dict:
+        """Сумма дневной статистики за дни start..end включительно"""
+        raise NotImplementedError
+
+    def available_days(self, limit: int | None = None) -> list:
+        """Дни со статистикой, сначала новые (не больше limit)"""
+        raise NotImplementedError
+
+    def available_months(self, limit: int | None = None) -> list:
+        """Месяцы со статистикой (первое число месяца), сначала новые (не больше limit)"""
+        raise NotImplementedError
+
+    def write_aggregate(self, scope: str, period: str, table: CounterTable) -> None:
+        """Сохранить готовый агрегат дня/месяца (для отложенной записи)"""
+
+    def load_rollup(self, month_str: str) -> tuple:
+        """Свёртка закрытых дней месяца: (последний учтённый день или None, агрегат)"""
+        return None, {}
+
+    def save_rollup(self, month_str: str, through: date, data: dict) -> None:
+        """Сохранить свёртку закрытых дней месяца"""
+
+    def close(self) -> None:
+        """Освободить ресурсы хранилища при остановке"""
+
+
+def merge_stats(target: dict, data: dict) -> dict:
+    """Прибавить агрегат data к target (формат data/daily|monthly)"""
+    for user_str, user_data in data.items():
+        entry = target.setdefault(user_str, {
+            'username': user_data.get('username', ''),
+            'full_name': user_data.get('full_name', ''),
+            'sales': {}
+        })
+        for tariff_key, count in user_data.get('sales', {}).items():
+            entry['sales'][tariff_key] = entry['sales'].get(tariff_key, 0) + count
+    return target
+
+
+class PeriodIndex:
+    """Индекс дней и месяцев со статистикой, отсортированный по возрастанию.
+
+    Строится сканированием каталогов при первом обращении и заново — только
+    когда меняется mtime одного из каталогов. Файлы, которые создаёт само
+    хранилище, учитываются через touch() без пересканирования; последние N
+    периодов отдаются срезом с конца за O(N).
+    """
+
+    def __init__(self, directories: list, scan):
+        self.directories = directories
+        self._scan = scan  # () -> (дни, месяцы)
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._days = []
+        self._months = []
+
+    def _dir_mtimes(self) -> tuple:
+        return tuple(os.stat(directory).st_mtime_ns if os.path.isdir(directory) else 0
+                     for directory in self.directories)
+
+    def _ensure(self) -> None:
+        mtimes = self._dir_mtimes()
+        if mtimes != self._mtimes:
+            days, months = self._scan()
+            self._days = sorted(days)
+            self._months = sorted(months)
+            self._mtimes = mtimes
+
+    @staticmethod
+    def _insert(periods: list, period: date) -> None:
+        position = bisect.bisect_left(periods, period)
+        if position == len(periods) or periods[position] != period:
+            periods.insert(position, period)
+
+    def touch(self, day: date | None = None, month: date | None = None) -> None:
+        """Учесть период, записанный самим хранилищем (вызывается после записи)"""
+        with self._lock:
+            if self._mtimes is None:
+                return
+            if day is not None:
+                self._insert(self._days, day)
+            if month is not None:
+                self._insert(self._months, month)
+            self._mtimes = self._dir_mtimes()
+
+    def invalidate(self) -> None:
+        """Пересканировать каталоги при следующем обращении (например, после удаления файла)"""
+        with self._lock:
+            self._mtimes = None
+
+    def newest_days(self, limit: int | None = None) -> list:
+        with self._lock:
+            self._ensure()
+            return self._days[:-limit - 1:-1] if limit else self._days[::-1]
+
+    def newest_months(self, limit: int | None = None) -> list:
+        with self._lock:
+            self._ensure()
+            return self._months[:-limit - 1:-1] if limit else self._months[::-1]
+
+
+class JsonStorage(SalesStorage):
+    """Журнал событий + JSON файлы data/daily и data/monthly как производные агрегаты.
+
+    Рядом с каждым JSON агрегатом лежит его бинарная форма (.bin, см. CounterTable),
+    которая читается вместо JSON, пока она не старше него. В бинарной форме
+    записано, сколько байт журнала учтено в агрегате: агрегат используется,
+    только пока журнал не вырос, иначе пересобирается из журнала.
+    """
+
+    write_behind = True
+
+    def __init__(self, daily_dir: str = 'data/daily', monthly_dir: str = 'data/monthly',
+                 events_dir: str = EVENTS_DIR):
+        self.daily_dir = daily_dir
+        self.monthly_dir = monthly_dir
+        self.event_log = SaleEventLog(events_dir)
+        self.periods = PeriodIndex([daily_dir, monthly_dir, events_dir], self._scan_periods)
+        # Запись идёт из пула потоков: изменения файлов выполняются по одному
+        self._lock = threading.Lock()
+        self._log_positions = {}  # день -> размер журнала после последней записи
+
+    def _path(self, scope: str, period: str) -> str:
+        if scope == 'rollup':
+            return os.path.join(self.monthly_dir, f'rollup_{period}.json')
+        directory = self.daily_dir if scope == 'day' else self.monthly_dir
+        return os.path.join(directory, f'sales_{period}.json')
+
+    def append_many(self, events: list) -> None:
+        by_day = defaultdict(list)
+        for event in events:
+            by_day[event_day(event)].append(event)
+        with self._lock:
+            for day, day_events in by_day.items():
+                is_new = not os.path.exists(self.event_log.path_for(day))
+                self._log_positions[day] = self.event_log.append(
+                    day, self._seed_events(day, day_events[0]['ts']) + day_events)
+                if is_new:
+                    self.periods.touch(day, day.replace(day=1))
+
+    def _seed_events(self, day: date, timestamp: str) -> list:
+        """Импорт дневного файла, созданного до журнала, перед первой записью в журнал дня"""
+        filename = self._path('day', day.isoformat())
+        if os.path.exists(self.event_log.path_for(day)) or not os.path.exists(filename):
+            return []
+        data = self.load_file(filename)
+        if not data:
+            return []
+        logger.info(f"Статистика {filename} перенесена в журнал событий")
+        return [{'ts': timestamp, 'type': 'import', 'scope': 'day', 'data': data}]
+
+    def load_file(self, filename: str) -> dict:
+        """Загрузка статистики из файла"""
+        if not os.path.exists(filename):
+            return {}
+
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки файла {filename}: {e}")
+            return {}
+
+    def log_position(self, day: date) -> int | None:
+        return self._log_positions.get(day)
+
+    @staticmethod
+    def _binary_path(filename: str) -> str:
+        return filename[:-len('.json')] + '.bin'
+
+    def _write_table(self, scope: str, period: str, table: CounterTable) -> None:
+        """JSON агрегат и его бинарная форма (бинарная пишется второй и потому не старше)"""
+        filename = self._path(scope, period)
+        binary_path = self._binary_path(filename)
+        with self._lock:
+            write_stats_file(filename, table.to_stats())
+            if table.counts:
+                write_file_atomic(binary_path, table.to_bytes())
+                if scope == 'day':
+                    self.periods.touch(day=date.fromisoformat(period))
+                else:
+                    self.periods.touch(month=date.fromisoformat(f'{period}-01'))
+            else:
+                if os.path.exists(binary_path):
+                    os.remove(binary_path)
+                self.periods.invalidate()
+
+    def _save_file(self, scope: str, period: str, table: CounterTable) -> None:
+        try:
+            self._write_table(scope, period, table)
+        except OSError as e:
+            logger.error(f"Ошибка сохранения агрегата {scope} {period}: {e}")
+
+    def _read_table(self, filename: str) -> tuple:
+        """Агрегат и учтённая в нём длина журнала (None — неизвестна, например у JSON без .bin)"""
+        binary_path = self._binary_path(filename)
+        if (os.path.exists(binary_path) and os.path.exists(filename)
+                and os.stat(binary_path).st_mtime_ns >= os.stat(filename).st_mtime_ns):
+            try:
+                with open(binary_path, 'rb') as f:
+                    table = CounterTable.from_bytes(f.read())
+                return table.to_stats(), table.log_offset
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Бинарные счётчики {binary_path} не прочитаны: {e}")
+        return self.load_file(filename), None
+
+    def load_table(self, filename: str) -> dict:
+        """Загрузка агрегата: из бинарной формы, если она актуальна, иначе из JSON"""
+        return self._read_table(filename)[0]
+
+    def load_day(self, day: date) -> dict:
+        """Статистика за день: из журнала, а для дней до журнала — из файла"""
+        filename = self._path('day', day.isoformat())
+        log_size = self.event_log.size([day])
+        if not log_size:
+            return self.load_table(filename)
+        data, covered = self._read_table(filename)
+        if covered == log_size:
+            return data
+
+        # Длина журнала берётся до чтения: события, дописанные во время чтения,
+        # попадут в агрегат сверх учтённой длины и вызовут ещё одну пересборку
+        table = CounterTable()
+        table.log_offset = log_size
+        for event in self.event_log.read(day):
+            table.apply(event)
+        self._save_file('day', day.isoformat(), table)
+        return table.to_stats()
+
+    def load_month(self, month_str: str) -> dict:
+        """Статистика за месяц (YYYY-MM) — сумма дневной статистики его дней.
+
+        Месяцы, закрытые до появления журнала, читаются из своего файла.
+        """
+        filename = self._path('month', month_str)
+        log_days = self.event_log.days_in_month(month_str)
+        if not log_days:
+            return self.load_table(filename)
+        log_size = self.event_log.size(log_days)
+        data, covered = self._read_table(filename)
+        if covered == log_size:
+            return data
+
+        table = CounterTable()
+        table.log_offset = log_size
+        for day in self.available_days():
+            if day.strftime('%Y-%m') == month_str:
+                table.add_stats(self.load_day(day))
+        self._save_file('month', month_str, table)
+        return table.to_stats()
+
+    def load_range(self, start: date, end: date) -> dict:
+        result = {}
+        day = start
+        while day <= end:
+            merge_stats(result, self.load_day(day))
+            day += timedelta(days=1)
+        return result
+
+    def _scan_periods(self) -> tuple:
+        """Полное сканирование каталогов для PeriodIndex"""
+        days = []
+        for file_path in glob.glob(os.path.join(self.daily_dir, 'sales_*.json')):
+            filename = os.path.basename(file_path)
+            # Извлекаем дату из имени файла: sales_YYYY-MM-DD.json
+            date_str = filename[6:-5]  # Убираем 'sales_' и '.json'
+            try:
+                days.append(datetime.strptime(date_str, '%Y-%m-%d').date())
+            except ValueError:
+                continue
+        # Дни, которые есть в журнале, но ещё не пересобраны в файл
+        log_days = self.event_log.days()
+        days = set(days) | set(log_days)
+
+        months = []
+        for file_path in glob.glob(os.path.join(self.monthly_dir, 'sales_*.json')):
+            filename = os.path.basename(file_path)
+            # Извлекаем месяц из имени файла: sales_YYYY-MM.json
+            month_str = filename[6:-5]
+            try:
+                months.append(datetime.strptime(month_str + '-01', '%Y-%m-%d').date())
+            except ValueError:
+                continue
+        months = set(months) | {day.replace(day=1) for day in log_days}
+        return days, months
+
+    def available_days(self, limit: int | None = None) -> list:
+        return self.periods.newest_days(limit)
+
+    def available_months(self, limit: int | None = None) -> list:
+        return self.periods.newest_months(limit)
+
+    def write_aggregate(self, scope: str, period: str, table: CounterTable) -> None:
+        self._write_table(scope, period, table)
+
+    def load_rollup(self, month_str: str) -> tuple:
+        stored = self.load_file(self._path('rollup', month_str))
+        if not stored:
+            return None, {}
+        return date.fromisoformat(stored['through']), stored.get('data', {})
+
+    def save_rollup(self, month_str: str, through: date, data: dict) -> None:
+        with self._lock:
+            write_stats_file(self._path('rollup', month_str), {'through': through.isoformat(), 'data': data})
+            # Файл свёртки лежит в каталоге месяцев: его запись не должна пересканировать индекс
+            self.periods.touch()
+
+
+class MonthMatrix:
+    """Файл месяца фиксированной разметки, отображённый в память (mmap).
+
+    Заголовок: сигнатура, версия, число дней, ёмкость и заполненность таблиц
+    тарифов и пользователей, отметка времени журнала, по которую учтены события.
+    Далее слоты ключей тарифов, слоты пользователей (id, username, full_name)
+    и матрица uint32 дни × пользователи × тарифы в порядке байт платформы.
+    Счётчики правятся на месте, чтение дня или месяца — срезы памяти без разбора JSON.
+    """
+
+    MAGIC = b'BRBM'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHHHIIq')
+    TARIFF_SLOT = 48
+    USER_SLOT = struct.Struct('<q64s128s')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        (magic, version, self.days, self.tariff_cap, tariff_count,
+         self.user_cap, user_count, self.stamp) = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"Неверный формат файла счётчиков {path}")
+
+        self._tariff_offset = self.HEADER.size
+        self._user_offset = self._tariff_offset + self.tariff_cap * self.TARIFF_SLOT
+        matrix_offset = self._user_offset + self.user_cap * self.USER_SLOT.size
+        self._cells = memoryview(self._map)[matrix_offset:].cast('I')
+        self._day_size = self.user_cap * self.tariff_cap
+
+        self.tariffs = []
+        self.tariff_positions = {}
+        for position in range(tariff_count):
+            start = self._tariff_offset + position * self.TARIFF_SLOT
+            key = bytes(self._map[start:start + self.TARIFF_SLOT]).rstrip(b'\0').decode('utf-8')
+            self.tariffs.append(key)
+            self.tariff_positions[key] = position
+
+        self.users = []
+        self.user_positions = {}
+        self.profiles = []
+        for position in range(user_count):
+            user_id, username, full_name = self.USER_SLOT.unpack_from(
+                self._map, self._user_offset + position * self.USER_SLOT.size)
+            self.users.append(str(user_id))
+            self.user_positions[str(user_id)] = position
+            self.profiles.append((self._decode(username), self._decode(full_name)))
+
+    @classmethod
+    def create(cls, path: str, days: int, tariff_cap: int, user_cap: int) -> 'MonthMatrix':
+        size = (cls.HEADER.size + tariff_cap * cls.TARIFF_SLOT + user_cap * cls.USER_SLOT.size
+                + days * user_cap * tariff_cap * COUNTER_ITEMSIZE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, days, tariff_cap, 0, user_cap, 0, 0))
+            f.truncate(size)
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    @staticmethod
+    def _decode(raw: bytes) -> str:
+        return raw.rstrip(b'\0').decode('utf-8', errors='ignore')
+
+    def close(self) -> None:
+        if getattr(self, '_cells', None) is not None:
+            self._cells.release()
+            self._cells = None
+        self._map.close()
+        self._file.close()
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def _write_header(self) -> None:
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION, self.days, self.tariff_cap,
+                              len(self.tariffs), self.user_cap, len(self.users), self.stamp)
+
+    def has_room(self, user_count: int, tariff_count: int) -> bool:
+        return user_count <= self.user_cap and tariff_count <= self.tariff_cap
+
+    def tariff_position(self, key: str) -> int | None:
+        """Индекс тарифа (новый ключ занимает слот; None — слоты закончились)"""
+        position = self.tariff_positions.get(key)
+        if position is None:
+            if len(self.tariffs) >= self.tariff_cap:
+                return None
+            encoded = key.encode('utf-8')[:self.TARIFF_SLOT]
+            position = len(self.tariffs)
+            start = self._tariff_offset + position * self.TARIFF_SLOT
+            self._map[start:start + self.TARIFF_SLOT] = encoded.ljust(self.TARIFF_SLOT, b'\0')
+            self.tariffs.append(key)
+            self.tariff_positions[key] = position
+            self._write_header()
+        return position
+
+    def user_position(self, user_str: str, username: str = '', full_name: str = '') -> int | None:
+        """Индекс пользователя (непустые имена обновляют профиль; None — слоты закончились)"""
+        position = self.user_positions.get(user_str)
+        if position is None:
+            if len(self.users) >= self.user_cap:
+                return None
+            position = len(self.users)
+            self.users.append(user_str)
+            self.user_positions[user_str] = position
+            self.profiles.append(('', ''))
+            self._write_header()
+
+        old_username, old_full_name = self.profiles[position]
+        profile = (username or old_username, full_name or old_full_name)
+        if profile != self.profiles[position] or not (old_username or old_full_name):
+            self.USER_SLOT.pack_into(
+                self._map, self._user_offset + position * self.USER_SLOT.size, int(user_str),
+                profile[0].encode('utf-8')[:64], profile[1].encode('utf-8')[:128])
+            self.profiles[position] = profile
+        return position
+
+    def _cell(self, day_number: int, user: int, tariff: int) -> int:
+        return (day_number - 1) * self._day_size + user * self.tariff_cap + tariff
+
+    def add(self, day_number: int, user_str: str, tariff_key: str, count: int = 1,
+            username: str = '', full_name: str = '') -> bool:
+        """Прибавить продажи на месте (False — не хватило слотов, нужен файл побольше)"""
+        user = self.user_position(user_str, username, full_name)
+        tariff = self.tariff_position(tariff_key)
+        if user is None or tariff is None:
+            return False
+        self._cells[self._cell(day_number, user, tariff)] += count
+        return True
+
+    def reset(self, day_number: int, user_str: str | None = None) -> None:
+        """Обнулить день целиком или строку одного пользователя"""
+        if user_str is None:
+            start, length = self._cell(day_number, 0, 0), self._day_size
+        elif user_str in self.user_positions:
+            start, length = self._cell(day_number, self.user_positions[user_str], 0), self.tariff_cap
+        else:
+            return
+        self._cells[start:start + length] = memoryview(bytes(length * COUNTER_ITEMSIZE)).cast('I')
+
+    def load(self, first_day: int, last_day: int) -> dict:
+        """Сумма дней first_day..last_day в формате data/daily|monthly"""
+        data = {}
+        stride = self._day_size
+        span = (last_day - first_day) * stride + 1
+        width = len(self.tariffs)
+        for user, user_str in enumerate(self.users):
+            start = self._cell(first_day, user, 0)
+            if first_day == last_day:
+                counts = self._cells[start:start + width].tolist()
+            else:
+                # Срез с шагом в размер дня — один счётчик тарифа по всем дням
+                counts = [sum(self._cells[start + tariff:start + tariff + span:stride])
+                          for tariff in range(width)]
+            sales = {self.tariffs[tariff]: count for tariff, count in enumerate(counts) if count}
+            if sales:
+                username, full_name = self.profiles[user]
+                data[user_str] = {'username': username, 'full_name': full_name, 'sales': sales}
+        return data
+
+
+class MmapStorage(JsonStorage):
+    """Журнал событий + файл-матрица счётчиков на месяц (см. MonthMatrix).
+
+    Журнал и JSON файлы по-прежнему ведутся как в JsonStorage, а продажи и
+    сбросы дополнительно применяются к матрице месяца на месте. Дни и месяцы,
+    для которых есть матрица, читаются из неё; матрица, отставшая от журнала
+    (сбой между записью журнала и матрицы), пересобирается при запуске.
+    """
+
+    write_behind = False
+
+    def __init__(self, matrix_dir: str = MATRIX_DIR, **kwargs):
+        super().__init__(**kwargs)
+        # Пересборка матрицы читает дневные агрегаты, которые сами берут блокировку
+        self._lock = threading.RLock()
+        self.matrix_dir = matrix_dir
+        self._matrices = {}  # YYYY-MM -> MonthMatrix
+        os.makedirs(self.matrix_dir, exist_ok=True)
+
+    def _matrix_path(self, month_str: str) -> str:
+        return os.path.join(self.matrix_dir, f'sales_{month_str}.mat')
+
+    def bootstrap(self) -> None:
+        """Открыть матрицы всех месяцев, достроив недостающие и отставшие от журнала"""
+        months = {day.strftime('%Y-%m') for day in super().available_days()}
+        with self._lock:
+            for month_str in sorted(months):
+                matrix = self._matrix(month_str)
+                log_days = self.event_log.days_in_month(month_str)
+                if matrix is None or self.event_log.last_modified(log_days) > matrix.stamp:
+                    self._rebuild(month_str)
+        logger.info(f"Матрицы счётчиков открыты: {len(self._matrices)} мес.")
+
+    def close(self) -> None:
+        with self._lock:
+            for matrix in self._matrices.values():
+                matrix.flush()
+                matrix.close()
+            self._matrices.clear()
+
+    def _matrix(self, month_str: str) -> MonthMatrix | None:
+        """Открытая матрица месяца или None, если файла нет"""
+        matrix = self._matrices.get(month_str)
+        if matrix is None and os.path.exists(self._matrix_path(month_str)):
+            try:
+                matrix = MonthMatrix(self._matrix_path(month_str))
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Матрица {month_str} не открыта и будет пересобрана: {e}")
+                return None
+            self._matrices[month_str] = matrix
+        return matrix
+
+    def _rebuild(self, month_str: str, user_cap: int = 0, tariff_cap: int = 0) -> MonthMatrix:
+        """Собрать матрицу месяца из журнала и дневных файлов (вызывается под блокировкой)"""
+        start, end = month_bounds(month_str)
+        days = {day: JsonStorage.load_day(self, day) for day in super().available_days()
+                if start <= day <= end}
+        users = {user_str for data in days.values() for user_str in data}
+        tariffs = {key for data in days.values() for user_data in data.values() for key in user_data['sales']}
+        user_cap = max(user_cap, MATRIX_MIN_USERS, 2 * len(users))
+        tariff_cap = max(tariff_cap, MATRIX_MIN_TARIFFS, len(TARIFF_INDEX), 2 * len(tariffs))
+
+        old = self._matrices.pop(month_str, None)
+        if old is not None:
+            old.close()
+        matrix = MonthMatrix.create(self._matrix_path(month_str), end.day, tariff_cap, user_cap)
+        for tariff_key in TARIFF_INDEX.keys:
+            matrix.tariff_position(tariff_key)
+        for day, data in days.items():
+            for user_str, user_data in data.items():
+                for tariff_key, count in user_data['sales'].items():
+                    matrix.add(day.day, user_str, tariff_key, count,
+                               user_data.get('username', ''), user_data.get('full_name', ''))
+        matrix.stamp = self.event_log.last_modified(self.event_log.days_in_month(month_str))
+        matrix._write_header()
+        self._matrices[month_str] = matrix
+        return matrix
+
+    def append_many(self, events: list) -> None:
+        super().append_many(events)
+        by_month = defaultdict(list)
+        for event in events:
+            by_month[event_day(event).strftime('%Y-%m')].append(event)
+
+        with self._lock:
+            for month_str, month_events in by_month.items():
+                matrix = self._matrix(month_str)
+                if matrix is None or not all(self._apply(matrix, event) for event in month_events):
+                    # Нет файла или закончились слоты: матрица собирается заново из журнала,
+                    # в который события уже записаны
+                    self._rebuild(month_str, 2 * len(matrix.users) if matrix else 0,
+                                  2 * len(matrix.tariffs) if matrix else 0)
+                    continue
+                days = {event_day(event) for event in month_events}
+                matrix.stamp = max(matrix.stamp, self.event_log.last_modified(list(days)))
+                matrix._write_header()
+                if FSYNC_WRITES:
+                    matrix.flush()
+
+    @staticmethod
+    def _apply(matrix: MonthMatrix, event: dict) -> bool:
+        """Применить событие дневного уровня к матрице (False — не хватило слотов)"""
+        kind = event.get('type')
+        day_number = event_day(event).day
+        if kind == 'sale':
+            return matrix.add(day_number, str(event['user_id']), event['tariff'], 1,
+                              event.get('username', ''), event.get('full_name', ''))
+        if event.get('scope') != 'day':
+            return True
+        if kind == 'import':
+            data = event.get('data', {})
+            if not matrix.has_room(len(set(matrix.users) | set(data)), len(matrix.tariffs) + sum(
+                    1 for user_data in data.values() for key in user_data.get('sales', {})
+                    if key not in matrix.tariff_positions)):
+                return False
+            for user_str, user_data in data.items():
+                for tariff_key, count in user_data.get('sales', {}).items():
+                    matrix.add(day_number, user_str, tariff_key, count,
+                               user_data.get('username', ''), user_data.get('full_name', ''))
+        elif kind == 'reset':
+            matrix.reset(day_number, None if event.get('user_id') is None else str(event['user_id']))
+        return True
+
+    def load_day(self, day: date) -> dict:
+        with self._lock:
+            matrix = self._matrix(day.strftime('%Y-%m'))
+            if matrix is not None:
+                return matrix.load(day.day, day.day)
+        return super().load_day(day)
+
+    def load_month(self, month_str: str) -> dict:
+        with self._lock:
+            matrix = self._matrix(month_str)
+            if matrix is not None:
+                return matrix.load(1, matrix.days)
+        return super().load_month(month_str)
+
+
+class SqliteStorage(SalesStorage):
+    """SQLite (WAL) хранилище: одна таблица продаж с индексом (day, user_id, tariff_key).
+
+    Агрегаты за день, месяц и произвольный диапазон — один GROUP BY по индексу.
+    Столбец scope отделяет импортированные дневные ('day') и месячные ('month')
+    итоги старых файлов от живых продаж ('all'), чтобы сохранить их расхождения.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sales (
+            id INTEGER PRIMARY KEY,
+            ts TEXT NOT NULL,
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            tariff_key TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 1,
+            scope TEXT NOT NULL DEFAULT 'all'
+        );
+        CREATE INDEX IF NOT EXISTS idx_sales_day_user_tariff ON sales (day, user_id, tariff_key);
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL DEFAULT '',
+            full_name TEXT NOT NULL DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS resets (
+            id INTEGER PRIMARY KEY,
+            scope TEXT NOT NULL,
+            period TEXT NOT NULL,
+            user_id INTEGER,
+            last_sale_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_resets_period ON resets (scope, period);
+        CREATE TABLE IF NOT EXISTS rollups (
+            month TEXT PRIMARY KEY,
+            through TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    # Продажа учитывается, если она новее последнего сброса своего периода
+    AGGREGATE_QUERY = """
+        SELECT s.user_id, COALESCE(u.username, ''), COALESCE(u.full_name, ''),
+               s.tariff_key, SUM(s.count)
+        FROM sales s
+        LEFT JOIN users u ON u.user_id = s.user_id
+        WHERE s.day BETWEEN ? AND ? AND s.scope IN ('all', ?)
+          AND s.id > COALESCE((
+              SELECT MAX(r.last_sale_id) FROM resets r
+              WHERE r.scope = ? AND r.period = ?
+                AND (r.user_id IS NULL OR r.user_id = s.user_id)
+          ), 0)
+        GROUP BY s.user_id, s.tariff_key
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL' if FSYNC_WRITES else 'PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+
+    def bootstrap(self) -> None:
+        """Однократный импорт существующих JSON файлов"""
+        with self._lock:
+            imported = self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone()
+        if not imported:
+            self.import_json(JsonStorage())
+
+    def import_json(self, source: JsonStorage) -> None:
+        """Импорт дневных и месячных итогов из JSON хранилища (включая журнал событий)"""
+        logger.info("Импорт JSON статистики в SQLite...")
+        timestamp = datetime.now().isoformat(timespec='seconds')
+        days = source.available_days()
+        months = source.available_months()
+
+        with self._lock, self._conn:
+            for day in days:
+                self._insert_import(timestamp, day.isoformat(), 'day', source.load_day(day))
+            for month in months:
+                self._insert_import(timestamp, month.isoformat(), 'month', source.load_month(month.strftime('%Y-%m')))
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (timestamp,))
+
+        logger.info(f"Импортировано дней: {len(days)}, месяцев: {len(months)}")
+
+    def _upsert_user(self, user_id: int, username: str, full_name: str) -> None:
+        self._conn.execute(
+            "INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET "
+            "username = COALESCE(NULLIF(excluded.username, ''), users.username), "
+            "full_name = COALESCE(NULLIF(excluded.full_name, ''), users.full_name)",
+            (user_id, username or '', full_name or '')
+        )
+
+    def _insert_import(self, timestamp: str, day_str: str, scope: str, data: dict) -> None:
+        for user_str, user_data in data.items():
+            user_id = int(user_str)
+            self._upsert_user(user_id, user_data.get('username', ''), user_data.get('full_name', ''))
+            self._conn.executemany(
+                "INSERT INTO sales (ts, day, user_id, tariff_key, count, scope) VALUES (?, ?, ?, ?, ?, ?)",
+                [(timestamp, day_str, user_id, tariff_key, count, scope)
+                 for tariff_key, count in user_data.get('sales', {}).items() if count]
+            )
+
+    def append_many(self, events: list) -> None:
+        with self._lock, self._conn:
+            for event in events:
+                self._append_event(event)
+
+    def _append_event(self, event: dict) -> None:
+        """Записать одно событие внутри открытой транзакции"""
+        kind = event.get('type')
+        day_str = event_day(event).isoformat()
+        if kind == 'sale':
+            self._upsert_user(event['user_id'], event.get('username', ''), event.get('full_name', ''))
+            self._conn.execute(
+                "INSERT INTO sales (ts, day, user_id, tariff_key) VALUES (?, ?, ?, ?)",
+                (event['ts'], day_str, event['user_id'], event['tariff'])
+            )
+        elif kind == 'reset':
+            period = day_str if event['scope'] == 'day' else day_str[:7]
+            last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM sales").fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO resets (scope, period, user_id, last_sale_id) VALUES (?, ?, ?, ?)",
+                (event['scope'], period, event.get('user_id'), last_id)
+            )
+        elif kind == 'import':
+            day_str = day_str if event['scope'] == 'day' else day_str[:7] + '-01'
+            self._insert_import(event['ts'], day_str, event['scope'], event.get('data', {}))
+
+    def _aggregate(self, start: str, end: str, scope: str, period: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute(self.AGGREGATE_QUERY, (start, end, scope, scope, period)).fetchall()
+
+        data = {}
+        for user_id, username, full_name, tariff_key, count in rows:
+            entry = data.setdefault(str(user_id), {'username': username, 'full_name': full_name, 'sales': {}})
+            entry['sales'][tariff_key] = count
+        return data
+
+    def load_day(self, day: date) -> dict:
+        day_str = day.isoformat()
+        return self._aggregate(day_str, day_str, 'day', day_str)
+
+    def load_month(self, month_str: str) -> dict:
+        """Сумма дней месяца; импортированные месячные итоги — только для месяцев без дней"""
+        start, end = month_bounds(month_str)
+        with self._lock:
+            has_days = self._conn.execute(
+                "SELECT 1 FROM sales WHERE day BETWEEN ? AND ? AND scope != 'month' LIMIT 1",
+                (start.isoformat(), end.isoformat())
+            ).fetchone()
+        if has_days:
+            return self.load_range(start, end)
+        return self._aggregate(start.isoformat(), end.isoformat(), 'month', month_str)
+
+    def load_range(self, start: date, end: date) -> dict:
+        # Сбросы дня применяются к своему дню, поэтому диапазон собирается из дней,
+        # если в нём были сбросы, иначе — одним запросом
+        with self._lock:
+            has_resets = self._conn.execute(
+                "SELECT 1 FROM resets WHERE scope = 'day' AND period BETWEEN ? AND ? LIMIT 1",
+                (start.isoformat(), end.isoformat())
+            ).fetchone()
+        if not has_resets:
+            return self._aggregate(start.isoformat(), end.isoformat(), 'day', '')
+
+        result = {}
+        day = start
+        while day <= end:
+            merge_stats(result, self.load_day(day))
+            day += timedelta(days=1)
+        return result
+
+    def load_rollup(self, month_str: str) -> tuple:
+        with self._lock:
+            row = self._conn.execute("SELECT through, data FROM rollups WHERE month = ?", (month_str,)).fetchone()
+        if not row:
+            return None, {}
+        return date.fromisoformat(row[0]), json.loads(row[1])
+
+    def save_rollup(self, month_str: str, through: date, data: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rollups (month, through, data) VALUES (?, ?, ?)",
+                (month_str, through.isoformat(), json.dumps(data, ensure_ascii=False))
+            )
+
+    def available_days(self, limit: int | None = None) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT day FROM sales WHERE scope != 'month' ORDER BY day DESC LIMIT ?",
+                (limit or -1,)
+            ).fetchall()
+        return [date.fromisoformat(row[0]) for row in rows]
+
+    def available_months(self, limit: int | None = None) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT substr(day, 1, 7) FROM sales ORDER BY 1 DESC LIMIT ?",
+                (limit or -1,)
+            ).fetchall()
+        return [date.fromisoformat(row[0] + '-01') for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> SalesStorage:
+    """Создать хранилище по имени из конфигурации"""
+    if backend == 'sqlite':
+        return SqliteStorage()
+    if backend == 'json':
+        return JsonStorage()
+    if backend == 'mmap':
+        return MmapStorage()
+    raise ValueError(f"Неизвестное хранилище: {backend}")
+
+
+# ============================================
+# Резидентные счётчики с отложенной записью
+# ============================================
+class AggregateStore:
+    """Счётчики текущего дня и месяца в памяти.
+
+    Все чтения статистики за сегодня и текущий месяц обслуживаются отсюда.
+    Месяц не пишется отдельно: это свёртка закрытых дней плюс живые счётчики
+    сегодняшнего дня. Свёртка пополняется одним днём при закрытии суток и
+    хранится в хранилище, поэтому месяц целиком не пересчитывается.
+
+    Для хранилищ с отложенной записью изменённый день сбрасывается на диск
+    в фоне — раз в flush_interval секунд или раньше, если накопилось
+    dirty_threshold изменений. Потеря несброшенного агрегата не страшна:
+    источник истины — журнал событий.
+    """
+
+    def __init__(self, storage: SalesStorage, executor: ThreadPoolExecutor | None = None,
+                 flush_interval: float = FLUSH_INTERVAL, dirty_threshold: int = FLUSH_DIRTY_THRESHOLD):
+        self.storage = storage
+        self.executor = executor
+        self.flush_interval = flush_interval
+        self.dirty_threshold = dirty_threshold
+
+        self.day = None
+        self.month = None
+        self.daily = CounterTable()
+        # Свёртка закрытых дней текущего месяца (по closed_through включительно)
+        self.closed = CounterTable()
+        self.closed_through = None
+        self._monthly = None  # свёртка + сегодня, собирается при первом чтении
+        self._rollup_stale = False
+
+        self._pending = {}  # (scope, period) -> агрегат, ожидающий записи
+        self._dirty_count = 0
+        self._wakeup = None
+        self._task = None
+        self._load_lock = asyncio.Lock()
+
+    def _load_rollup(self, month_str: str, today: date, rebuild: bool) -> tuple:
+        """Загрузить свёртку месяца и досчитать недостающие закрытые дни (в пуле потоков)"""
+        through, stored = (None, {}) if rebuild else self.storage.load_rollup(month_str)
+        closed = CounterTable.from_stats(stored)
+        start, _ = month_bounds(month_str)
+        day = through + timedelta(days=1) if through else start
+        if day >= today:
+            return through, closed
+
+        while day < today:
+            closed.add_stats(self.storage.load_day(day))
+            through = day
+            day += timedelta(days=1)
+        self.storage.save_rollup(month_str, through, closed.to_stats())
+        return through, closed
+
+    async def _close_day(self, month: str) -> None:
+        """Прибавить закрывшийся день к свёртке месяца"""
+        loop = asyncio.get_running_loop()
+        if self.month == month:
+            self.closed.merge(self.daily)
+            self.closed_through = self.day
+            snapshot = self.closed.to_stats()
+            await loop.run_in_executor(self.executor, self.storage.save_rollup, month, self.day, snapshot)
+        else:
+            # Закрылся и месяц: его итог записывается один раз
+            final = self.closed.copy().merge(self.daily)
+            await loop.run_in_executor(self.executor, self.storage.write_aggregate, 'month', self.month, final)
+
+    async def refresh(self) -> None:
+        """Подгрузить счётчики при первом обращении и при смене дня/месяца"""
+        today = date.today()
+        if self.day == today and not self._rollup_stale:
+            return
+
+        async with self._load_lock:
+            if self.day == today and not self._rollup_stale:
+                return
+
+            loop = asyncio.get_running_loop()
+            month = today.strftime('%Y-%m')
+            if self.day is not None and self.day != today and not self._rollup_stale:
+                await self._close_day(month)
+            if self.month != month or self._rollup_stale:
+                rebuild = self._rollup_stale and self.month == month
+                self._rollup_stale = False
+                self.closed_through, self.closed = await loop.run_in_executor(
+                    self.executor, self._load_rollup, month, today, rebuild
+                )
+                self.month = month
+            if self.day != today:
+                stored = await loop.run_in_executor(self.executor, self.storage.load_day, today)
+                self.daily = CounterTable.from_stats(stored)
+                self.day = today
+            self._monthly = None
+
+    def reload(self) -> None:
+        """Перечитать день и пересобрать свёртку при следующем обращении (после миграции файлов)"""
+        self.day = None
+        self._rollup_stale = True
+        self._monthly = None
+
+    async def daily_table(self) -> CounterTable:
+        """Живые счётчики сегодняшнего дня"""
+        await self.refresh()
+        return self.daily
+
+    async def monthly_table(self) -> CounterTable:
+        """Счётчики текущего месяца: свёртка закрытых дней плюс сегодня"""
+        await self.refresh()
+        if self._monthly is None:
+            self._monthly = self.closed.copy().merge(self.daily)
+        return self._monthly
+
+    def apply(self, event: dict) -> None:
+        """Учесть событие в памяти и пометить день для записи.
+
+        Перед записью события в журнал нужно вызвать refresh(), иначе первая
+        подгрузка с диска уже увидит это событие и оно учтётся дважды.
+        События прошлого дня (сброс или продажа из пачки на стыке суток) в живые
+        счётчики не попадают: день пересоберётся из журнала, свёртка месяца — тоже.
+        """
+        day = event_day(event)
+        if day != self.day:
+            # Отложенный агрегат этого дня уже не полон и не должен перезаписать файл
+            self._pending.pop(('day', day.isoformat()), None)
+            if day.strftime('%Y-%m') == self.month:
+                # Закрытый день текущего месяца: свёртка пересоберётся при следующем чтении
+                self._rollup_stale = True
+                self._monthly = None
+            return
+
+        self.daily.apply(event)
+        # Пачка уже в журнале: счётчики дня учитывают его ровно до этой длины
+        self.daily.log_offset = self.storage.log_position(day)
+        if event.get('type') == 'sale' and self._monthly is not None:
+            self._monthly.apply(event)
+        else:
+            self._monthly = None
+
+        if not self.storage.write_behind:
+            return
+        self._pending[('day', self.day.isoformat())] = self.daily
+        self._dirty_count += 1
+        if self._dirty_count >= self.dirty_threshold and self._wakeup:
+            self._wakeup.set()
+
+    def _take_pending(self) -> dict:
+        """Снимок изменённых файлов (сериализуется в потоке цикла событий)"""
+        snapshot = {key: table.copy() for key, table in self._pending.items()}
+        self._pending = {}
+        self._dirty_count = 0
+        return snapshot
+
+    def _write(self, snapshot: dict) -> None:
+        for (scope, period), table in snapshot.items():
+            try:
+                self.storage.write_aggregate(scope, period, table)
+            except OSError as e:
+                logger.error(f"Ошибка сохранения агрегата {scope} {period}: {e}")
+
+    def flush(self) -> None:
+        """Синхронный сброс всех изменений (при остановке бота)"""
+        self._write(self._take_pending())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self._write, self._take_pending())
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.flush)
+
+
+# ============================================
+# Групповая фиксация записей
+# ============================================
+class GroupCommitWriter:
+    """Единственный писатель событий в хранилище.
+
+    События, пришедшие в течение window секунд после первого, фиксируются
+    одной записью в журнал (или одной транзакцией SQLite), затем применяются
+    к счётчикам в памяти. Каждая фиксация отчитывается размером пачки и
+    задержкой; сводка выводится при остановке.
+    """
+
+    def __init__(self, storage: SalesStorage, aggregates: AggregateStore,
+                 executor: ThreadPoolExecutor | None = None, window: float = GROUP_COMMIT_WINDOW):
+        self.storage = storage
+        self.aggregates = aggregates
+        self.executor = executor
+        self.window = window
+
+        self._queue = asyncio.Queue()
+        self._task = None
+        # Получают список зафиксированных событий после их учёта в счётчиках
+        self.listeners = []
+
+        # Статистика фиксаций
+        self.batches = 0
+        self.events = 0
+        self.max_batch = 0
+        self.last_batch = 0
+        self.last_latency_ms = 0.0
+
+    async def submit(self, event: dict) -> None:
+        """Поставить событие в очередь и дождаться его фиксации"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((event, future))
+        await future
+
+    async def _collect(self) -> list:
+        """Первое событие плюс всё, что успело прийти за окно"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while True:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _commit(self, batch: list) -> None:
+        events = [event for event, _ in batch]
+        started = time.perf_counter()
+        try:
+            # Счётчики подгружаются до записи, чтобы пачка не учлась дважды
+            await self.aggregates.refresh()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.storage.append_many, events)
+        except Exception as e:
+            logger.error(f"Ошибка групповой записи ({len(events)} событий): {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for event in events:
+            self.aggregates.apply(event)
+        for listener in self.listeners:
+            listener(events)
+
+        self.batches += 1
+        self.events += len(events)
+        self.max_batch = max(self.max_batch, len(events))
+        self.last_batch = len(events)
+        self.last_latency_ms = (time.perf_counter() - started) * 1000
+        logger.debug(f"Фиксация: {len(events)} событий за {self.last_latency_ms:.1f} мс")
+
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def _run(self) -> None:
+        while True:
+            await self._commit(await self._collect())
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Дописываем то, что успели поставить в очередь до остановки
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await self._commit(batch)
+
+        if self.batches:
+            logger.info(
+                f"Групповая запись: {self.events} событий в {self.batches} фиксациях, "
+                f"макс. пачка {self.max_batch}, последняя задержка {self.last_latency_ms:.1f} мс"
+            )
+
+
+# ============================================
+# Сессии пользователей
+# ============================================
+class SessionStore:
+    """Постоянный реестр пользователей: id, username, full_name, роль и продажи сессии.
+
+    По JSON файлу на пользователя в data/sessions. Сессия читается с диска при
+    первом обращении к пользователю; создание сессии записывается сразу, а
+    изменения счётчиков продаж — отложенно, только для изменённых сессий.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, directory: str = SESSIONS_DIR,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.directory = directory
+        self.executor = executor
+        self.flush_interval = flush_interval
+        self._sessions = {}  # user_id -> сессия или None, если её нет на диске
+        self._dirty = set()
+        self._task = None
+
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self.directory, f'{user_id}.json')
+
+    def _read(self, user_id: int) -> dict | None:
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка загрузки сессии {path}: {e}")
+            return None
+
+    def _write(self, snapshot: dict) -> None:
+        for user_id, session in snapshot.items():
+            try:
+                write_file_atomic(self._path(user_id),
+                                  json.dumps(session, ensure_ascii=False, indent=2).encode('utf-8'))
+            except OSError as e:
+                logger.error(f"Ошибка сохранения сессии {user_id}: {e}")
+
+    async def get(self, user_id: int) -> dict | None:
+        if user_id not in self._sessions:
+            loop = asyncio.get_running_loop()
+            session = await loop.run_in_executor(self.executor, self._read, user_id)
+            # Пока шло чтение, сессию мог создать или загрузить другой обработчик
+            self._sessions.setdefault(user_id, session)
+        return self._sessions[user_id]
+
+    async def save(self, user_id: int, session: dict) -> None:
+        """Создать или заменить сессию с немедленной записью на диск"""
+        self._sessions[user_id] = session
+        self._dirty.discard(user_id)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._write, {user_id: dict(session)})
+
+    def mark_dirty(self, user_id: int) -> None:
+        """Сессия изменилась в памяти и будет записана при следующем сбросе"""
+        self._dirty.add(user_id)
+
+    def _take_dirty(self) -> dict:
+        snapshot = {user_id: json.loads(json.dumps(self._sessions[user_id]))
+                    for user_id in self._dirty if self._sessions.get(user_id)}
+        self._dirty.clear()
+        return snapshot
+
+    async def flush(self) -> None:
+        if self._dirty:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self._write, self._take_dirty())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# ============================================
+# Итоги периодов
+# ============================================
+class DataVersions:
+    """Версии данных периодов ('YYYY-MM-DD' и 'YYYY-MM').
+
+    Версия дня и его месяца растёт при каждой зафиксированной продаже или
+    сбросе этого дня; по ней проверяются запомненные итоги и готовые экраны.
+    Версия диапазона дней — версии всех задетых им месяцев.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._epoch = 0
+
+    def version(self, period: str) -> tuple:
+        if '..' in period:
+            # Диапазон дней меняется вместе с любым из задетых им месяцев
+            start, end = (date.fromisoformat(part) for part in period.split('..'))
+            return self._epoch, tuple(self._versions.get(month, 0) for month in months_between(start, end))
+        return self._epoch, self._versions.get(period, 0)
+
+    def on_commit(self, events: list) -> None:
+        """Слушатель GroupCommitWriter: поднять версии затронутых дней и месяцев"""
+        for event in events:
+            day = event_day(event)
+            for period in (day.isoformat(), day.strftime('%Y-%m')):
+                self._versions[period] = self._versions.get(period, 0) + 1
+
+    def invalidate_all(self) -> None:
+        """Данные изменились в обход журнала (например, миграцией) — устарело всё"""
+        self._epoch += 1
+
+
+class UserTotals:
+    """Итоги пользователя за период: продажи по тарифам, количество, доход"""
+
+    def __init__(self, user_id: str, username: str = '', full_name: str = '',
+                 sales: dict | None = None, total: int = 0, revenue: int = 0):
+        self.user_id = user_id
+        self.username = username
+        self.full_name = full_name
+        self.sales = sales or {}
+        self.total = total
+        self.revenue = revenue
+
+    @property
+    def avg_check(self) -> float:
+        return round(self.revenue / self.total, 2) if self.total > 0 else 0
+
+
+class PeriodTotals:
+    """Итоги периода: по пользователям, по тарифам и общие — за один проход по счётчикам"""
+
+    def __init__(self, period: str):
+        self.period = period
+        self.users = {}    # user_id_str -> UserTotals
+        self.tariffs = {}  # tariff_key -> количество
+        self.total = 0
+        self.revenue = 0
+
+    @classmethod
+    def from_table(cls, period: str, table: CounterTable) -> 'PeriodTotals':
+        result = cls(period)
+        keys = table.index.keys
+        for user_str, row in table.counts.items():
+            sales = {keys[position]: count for position, count in enumerate(row) if count}
+            for tariff_key, count in sales.items():
+                result.tariffs[tariff_key] = result.tariffs.get(tariff_key, 0) + count
+            username, full_name = table.profiles[user_str]
+            user = UserTotals(user_str, username, full_name, sales,
+                              table.total(user_str), table.revenue(user_str))
+            result.users[user_str] = user
+            result.total += user.total
+            result.revenue += user.revenue
+        return result
+
+    @property
+    def avg_check(self) -> float:
+        return round(self.revenue / self.total, 2) if self.total > 0 else 0
+
+    def user(self, user_id: int | str) -> UserTotals:
+        """Итоги одного пользователя (пустые, если продаж не было)"""
+        return self.users.get(str(user_id)) or UserTotals(str(user_id))
+
+
+class DayBlock:
+    """Плотный блок счётчиков дни × пользователи × тарифы в одном array('I').
+
+    Собирается из дневных CounterTable копированием строк целиком; сумма любых
+    дней блока — срез с шагом в размер дня для каждой пары пользователь/тариф
+    (как в MonthMatrix), без обхода словарей каждого дня.
+    """
+
+    def __init__(self, start: date, days: int, users: list, profiles: dict,
+                 index: TariffIndex | None = None):
+        self.start = start
+        self.days = days
+        self.users = users
+        self.user_positions = {user_str: position for position, user_str in enumerate(users)}
+        self.profiles = profiles
+        self.index = index or TARIFF_INDEX
+        self.width = len(self.index)
+        self.day_size = len(users) * self.width
+        self.cells = array('I', bytes(COUNTER_ITEMSIZE * days * self.day_size))
+
+    @classmethod
+    def from_tables(cls, start: date, tables: list) -> 'DayBlock':
+        """Блок из дневных счётчиков подряд с дня start (None — день без продаж)"""
+        users = []
+        profiles = {}
+        for table in tables:
+            if table is None:
+                continue
+            for user_str, profile in table.profiles.items():
+                if user_str not in profiles:
+                    users.append(user_str)
+                if any(profile) or user_str not in profiles:
+                    profiles[user_str] = profile
+
+        block = cls(start, len(tables), users, profiles)
+        for day_number, table in enumerate(tables):
+            if table is None:
+                continue
+            for user_str, row in table.counts.items():
+                offset = day_number * block.day_size + block.user_positions[user_str] * block.width
+                block.cells[offset:offset + len(row)] = row
+        return block
+
+    @classmethod
+    def load(cls, storage: SalesStorage, start: date, end: date,
+             today_table: CounterTable | None = None) -> 'DayBlock':
+        """Дневные счётчики хранилища за start..end (в пуле потоков; сегодня — today_table)"""
+        today = date.today()
+        known = set(storage.available_days())
+        tables = []
+        day = start
+        while day <= end:
+            if day == today and today_table is not None:
+                tables.append(today_table)
+            elif day in known:
+                tables.append(CounterTable.from_stats(storage.load_day(day)))
+            else:
+                tables.append(None)
+            day += timedelta(days=1)
+        return cls.from_tables(start, tables)
+
+    def cumulative(self, user_str: str, position: int) -> array:
+        """Накопленные по дням продажи пользователя по тарифу (элемент d — дни 0..d)"""
+        start = self.user_positions[user_str] * self.width + position
+        return array('I', accumulate(self.cells[start::self.day_size]))
+
+    def table(self, first: int = 0, last: int | None = None) -> CounterTable:
+        """Сумма дней first..last (номера от начала блока) как CounterTable"""
+        last = self.days - 1 if last is None else last
+        table = CounterTable(self.index)
+        if last < first:
+            return table
+        stride = self.day_size
+        span = (last - first) * stride + 1
+        for position, user_str in enumerate(self.users):
+            start = first * stride + position * self.width
+            counts = array('I', [sum(self.cells[start + tariff:start + tariff + span:stride])
+                                 for tariff in range(self.width)])
+            if any(counts):
+                table.counts[user_str] = counts
+                table.profiles[user_str] = self.profiles[user_str]
+        return table
+
+
+class PrefixSumIndex:
+    """Накопленные суммы продаж по календарным дням от первого дня истории.
+
+    На пару (пользователь, тариф) — array('I'), элемент d которого равен продажам
+    за дни origin..origin+d, поэтому итог любого диапазона — две выборки и
+    вычитание на пару, сколько бы истории ни накопилось. Продажи последнего
+    учтённого дня прибавляются к последнему элементу (слушатель GroupCommitWriter),
+    новый день дописывается повтором последнего значения. Сбросы, импорт и
+    события прошлых дней помечают индекс устаревшим: он пересобирается с нуля
+    при следующем запросе, как и после миграции (invalidate).
+    """
+
+    def __init__(self, storage: SalesStorage, aggregates: AggregateStore,
+                 executor: ThreadPoolExecutor | None = None):
+        self.storage = storage
+        self.aggregates = aggregates
+        self.executor = executor
+        self.index = TARIFF_INDEX
+        self.origin = None  # первый день истории
+        self.end = None     # последний учтённый день
+        self.series = {}    # (user_str, позиция тарифа) -> array('I') накопленных сумм
+        self.profiles = {}  # user_str -> (username, full_name)
+        self.rebuilds = 0
+        self._stale = True
+        self._pending = None  # события, зафиксированные во время пересборки
+        self._build_lock = asyncio.Lock()
+
+    def invalidate(self) -> None:
+        """Данные изменились в обход журнала — пересобрать при следующем запросе"""
+        self._stale = True
+
+    def _build(self, today: date, today_table: CounterTable) -> tuple:
+        """Индекс с нуля по дневной статистике хранилища (в пуле потоков)"""
+        days = [day for day in self.storage.available_days() if day < today]
+        origin = min(days) if days else today
+        block = DayBlock.load(self.storage, origin, today, today_table)
+        series = {}
+        for user_str in block.users:
+            for position in range(block.width):
+                cumulative = block.cumulative(user_str, position)
+                if cumulative[-1]:
+                    series[(user_str, position)] = cumulative
+        return origin, series, block.profiles
+
+    async def ensure(self) -> None:
+        """Пересобрать устаревший индекс и дотянуть его до сегодняшнего дня"""
+        today = date.today()
+        if self._stale:
+            async with self._build_lock:
+                if self._stale:
+                    # Снимок сегодняшнего дня и начало буфера — без await между ними,
+                    # чтобы каждое событие попало ровно в одно из двух
+                    today_table = (await self.aggregates.daily_table()).copy()
+                    self._pending = []
+                    self._stale = False
+                    loop = asyncio.get_running_loop()
+                    try:
+                        origin, series, profiles = await loop.run_in_executor(
+                            self.executor, self._build, today, today_table)
+                    except Exception:
+                        self._stale = True
+                        raise
+                    finally:
+                        pending, self._pending = self._pending, None
+                    self.origin, self.end, self.series, self.profiles = origin, today, series, profiles
+                    self.rebuilds += 1
+                    for event in pending:
+                        self._apply(event)
+        self._extend(today)
+
+    def _extend(self, day: date) -> None:
+        """Дописать дни end+1..day без продаж (повтор последнего значения)"""
+        if self.end is None or day <= self.end:
+            return
+        gap = (day - self.end).days
+        for cumulative in self.series.values():
+            cumulative.extend(array('I', [cumulative[-1]]) * gap)
+        self.end = day
+
+    def _apply(self, event: dict) -> None:
+        day = event_day(event)
+        if event.get('type') != 'sale' or (self.end is not None and day < self.end):
+            self._stale = True
+            return
+        if self.end is None:
+            self.origin = self.end = day
+        self._extend(day)
+
+        user_str = str(event['user_id'])
+        key = (user_str, self.index.intern(event['tariff']))
+        cumulative = self.series.get(key)
+        if cumulative is None:
+            cumulative = array('I', bytes(COUNTER_ITEMSIZE * ((self.end - self.origin).days + 1)))
+            self.series[key] = cumulative
+        cumulative[-1] += 1
+        username, full_name = event.get('username', ''), event.get('full_name', '')
+        if username or full_name or user_str not in self.profiles:
+            self.profiles[user_str] = (username, full_name)
+
+    def on_commit(self, events: list) -> None:
+        """Слушатель GroupCommitWriter"""
+        for event in events:
+            if self._pending is not None:
+                self._pending.append(event)
+            elif not self._stale:
+                self._apply(event)
+
+    def table(self, start: date, end: date) -> CounterTable:
+        """Продажи за дни start..end: по две выборки на пару (пользователь, тариф)"""
+        table = CounterTable(self.index)
+        if self.origin is None or end < self.origin or start > self.end:
+            return table
+        first = max((start - self.origin).days, 0)
+        last = min((end - self.origin).days, (self.end - self.origin).days)
+        keys = self.index.keys
+        for (user_str, position), cumulative in self.series.items():
+            count = cumulative[last] - (cumulative[first - 1] if first else 0)
+            if count:
+                table.add(user_str, keys[position], count, *self.profiles.get(user_str, ('', '')))
+        return table
+
+
+class StatsEngine:
+    """Единый расчёт итогов для статистики, отчёта, калькулятора и экспорта.
+
+    Период — день 'YYYY-MM-DD', месяц 'YYYY-MM' или диапазон дней
+    'YYYY-MM-DD..YYYY-MM-DD' (см. range_period); сегодняшний день и текущий
+    месяц берутся из счётчиков в памяти, остальные — из хранилища, диапазон —
+    из индекса накопленных сумм (или суммой по блоку DayBlock, если индекса нет).
+    Итоги запоминаются (LRU) до изменения версии данных периода.
+    """
+
+    def __init__(self, storage: SalesStorage, aggregates: AggregateStore, versions: DataVersions,
+                 executor: ThreadPoolExecutor | None = None, capacity: int = TOTALS_CACHE_SIZE,
+                 prefix_sums: PrefixSumIndex | None = None):
+        self.storage = storage
+        self.aggregates = aggregates
+        self.versions = versions
+        self.executor = executor
+        self.capacity = capacity
+        self.prefix_sums = prefix_sums
+        self._memo = OrderedDict()  # period -> (версия, PeriodTotals)
+
+    async def _load(self, period: str) -> CounterTable:
+        today = date.today()
+        loop = asyncio.get_running_loop()
+        if '..' in period:
+            start, end = (date.fromisoformat(part) for part in period.split('..'))
+            if self.prefix_sums is not None:
+                await self.prefix_sums.ensure()
+                return self.prefix_sums.table(start, end)
+            # Сегодняшние счётчики копируются в цикле событий, пока их не меняет продажа
+            today_table = (await self.aggregates.daily_table()).copy() if start <= today <= end else None
+            block = await loop.run_in_executor(self.executor, DayBlock.load, self.storage, start, end, today_table)
+            return block.table()
+        if len(period) == len('YYYY-MM-DD'):
+            if period == today.isoformat():
+                return await self.aggregates.daily_table()
+            data = await loop.run_in_executor(self.executor, self.storage.load_day, date.fromisoformat(period))
+        else:
+            if period == today.strftime('%Y-%m'):
+                return await self.aggregates.monthly_table()
+            data = await loop.run_in_executor(self.executor, self.storage.load_month, period)
+        return CounterTable.from_stats(data)
+
+    async def totals(self, period: str) -> PeriodTotals:
+        # Версия берётся до загрузки: фиксация во время неё сделает результат устаревшим
+        version = self.versions.version(period)
+        cached = self._memo.get(period)
+        if cached is not None and cached[0] == version:
+            self._memo.move_to_end(period)
+            return cached[1]
+
+        result = PeriodTotals.from_table(period, await self._load(period))
+        self._memo[period] = (version, result)
+        self._memo.move_to_end(period)
+        if len(self._memo) > self.capacity:
+            self._memo.popitem(last=False)
+        return result
+
+
+# ============================================
+# Рейтинги
+# ============================================
+class RankIndex:
+    """Рейтинг: упорядоченный список (-очки, участник) с поиском bisect.
+
+    Изменение очков участника — удаление и вставка по двоичному поиску:
+    поиск O(log n), но сдвиг элементов списка O(n). Участников (менеджеров,
+    тарифов) десятки, поэтому сдвиг — одно короткое копирование памяти и
+    дешевле сбалансированного дерева. Первые N мест — срез без пересортировки.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self._order = []
+
+    def add(self, member: str, delta: int) -> None:
+        old = self.scores.get(member, 0)
+        if old:
+            del self._order[bisect.bisect_left(self._order, (-old, member))]
+        new = old + delta
+        if new:
+            self.scores[member] = new
+            bisect.insort(self._order, (-new, member))
+        else:
+            self.scores.pop(member, None)
+
+    def top(self, limit: int) -> list:
+        """Первые limit мест: [(участник, очки)]"""
+        return [(member, -score) for score, member in self._order[:limit]]
+
+    def rank(self, member: str) -> int | None:
+        """Место участника (с 1) или None, если очков нет"""
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return bisect.bisect_left(self._order, (-score, member)) + 1
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+
+class Leaderboard:
+    """Живые рейтинги за день, неделю (с понедельника) и месяц.
+
+    На каждый период три RankIndex: менеджеры по числу продаж ('sales') и по
+    доходу из PRICE_MAP ('revenue'), тарифы по числу продаж ('tariffs').
+    Рейтинги засеваются итогами StatsEngine и дальше ведутся слушателем
+    GroupCommitWriter: продажа сегодняшнего дня двигает участника в каждом
+    рейтинге. Сбросы, импорт, события прошлых дней и смена дня помечают
+    рейтинги устаревшими — они засеваются заново при следующем запросе.
+    """
+
+    PERIODS = ('day', 'week', 'month')
+    METRICS = ('sales', 'revenue', 'tariffs')
+
+    def __init__(self, stats_engine: StatsEngine):
+        self.stats_engine = stats_engine
+        self.day = None
+        self.boards = {}    # (период, метрика) -> RankIndex
+        self.profiles = {}  # user_str -> (username, full_name)
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def period_key(kind: str, today: date) -> str:
+        """Ключ периода StatsEngine для дня, недели или месяца, содержащих today"""
+        if kind == 'day':
+            return today.isoformat()
+        if kind == 'week':
+            return range_period(today - timedelta(days=today.weekday()), today)
+        return today.strftime('%Y-%m')
+
+    def invalidate(self) -> None:
+        self._stale = True
+
+    async def ensure(self) -> None:
+        """Засеять рейтинги, если они устарели или сменился день"""
+        today = date.today()
+        if not self._stale and self.day == today:
+            return
+
+        async with self._lock:
+            if not self._stale and self.day == today:
+                return
+            versions = self.stats_engine.versions
+            keys = {kind: self.period_key(kind, today) for kind in self.PERIODS}
+            while True:
+                # Пока идёт засев, события не применяются: если за это время что-то
+                # зафиксировали, версии изменятся и засев повторится
+                self._stale = True
+                before = [versions.version(key) for key in keys.values()]
+                totals = {kind: await self.stats_engine.totals(key) for kind, key in keys.items()}
+                if before == [versions.version(key) for key in keys.values()]:
+                    break
+
+            self.boards = {}
+            self.profiles = {}
+            for kind, period_totals in totals.items():
+                sales, revenue, tariffs = RankIndex(), RankIndex(), RankIndex()
+                for user_str, user in period_totals.users.items():
+                    sales.add(user_str, user.total)
+                    revenue.add(user_str, user.revenue)
+                    if user.username or user.full_name or user_str not in self.profiles:
+                        self.profiles[user_str] = (user.username, user.full_name)
+                for tariff_key, count in period_totals.tariffs.items():
+                    tariffs.add(tariff_key, count)
+                self.boards[(kind, 'sales')] = sales
+                self.boards[(kind, 'revenue')] = revenue
+                self.boards[(kind, 'tariffs')] = tariffs
+            self.day = today
+            self._stale = False
+
+    def on_commit(self, events: list) -> None:
+        """Слушатель GroupCommitWriter: O(log n) на продажу в каждом рейтинге"""
+        for event in events:
+            if self._stale:
+                return
+            if event.get('type') != 'sale' or event_day(event) != self.day:
+                self._stale = True
+                return
+            user_str = str(event['user_id'])
+            tariff_key = event['tariff']
+            price = TARIFF_CATALOG.price(tariff_key)
+            for kind in self.PERIODS:
+                self.boards[(kind, 'sales')].add(user_str, 1)
+                if price:
+                    self.boards[(kind, 'revenue')].add(user_str, price)
+                self.boards[(kind, 'tariffs')].add(tariff_key, 1)
+            if event.get('username') or event.get('full_name'):
+                self.profiles[user_str] = (event.get('username', ''), event.get('full_name', ''))
+
+    async def top(self, kind: str, metric: str, limit: int = LEADERBOARD_SIZE) -> list:
+        await self.ensure()
+        return self.boards[(kind, metric)].top(limit)
+
+    async def rank(self, kind: str, metric: str, member: str) -> tuple:
+        """(место или None, число участников)"""
+        await self.ensure()
+        board = self.boards[(kind, metric)]
+        return board.rank(member), len(board)
+
+
+# ============================================
+# Кэш готовых экранов
+# ============================================
+class RenderCache:
+    """LRU кэш готовых экранов статистики: (текст, клавиатура).
+
+    Ключ — (экран, период, пользователь или 'all'); вместе с экраном хранится
+    версия данных периода (DataVersions) на момент отрисовки, экран другой
+    версии считается промахом и перерисовывается.
+    """
+
+    def __init__(self, capacity: int = RENDER_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, version: tuple) -> tuple | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: tuple, version: tuple, screen: tuple) -> None:
+        self._entries[key] = (version, screen)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+# ============================================
+# Экспорт продаж
+# ============================================
+EXPORT_FIELDS = ['date', 'user_id', 'username', 'full_name', 'tariff', 'tariff_name', 'count', 'price', 'revenue']
+
+
+class ExportCancelled(Exception):
+    """Экспорт отменён пользователем"""
+
+
+def iter_export_rows(storage: SalesStorage, start: date, end: date, on_day=None):
+    """Строки продаж за дни start..end: по одной на (день, пользователь, тариф).
+
+    Дни читаются из хранилища по одному, поэтому в памяти не больше одного дня
+    независимо от длины периода. on_day(готово, всего) вызывается перед каждым днём.
+    """
+    days = sorted(day for day in storage.available_days() if start <= day <= end)
+    for number, day in enumerate(days):
+        if on_day:
+            on_day(number, len(days))
+        data = storage.load_day(day)
+        for user_str in sorted(data):
+            user_data = data[user_str]
+            for tariff_key, count in sorted(user_data.get('sales', {}).items()):
+                if not count:
+                    continue
+                price = TARIFF_CATALOG.price(tariff_key)
+                yield {
+                    'date': day.isoformat(),
+                    'user_id': user_str,
+                    'username': user_data.get('username', ''),
+                    'full_name': user_data.get('full_name', ''),
+                    'tariff': tariff_key,
+                    'tariff_name': TARIFF_CATALOG.display_name(tariff_key),
+                    'count': count,
+                    'price': price,
+                    'revenue': price * count
+                }
+
+
+def write_export(storage: SalesStorage, fmt: str, start: date, end: date,
+                 directory: str = EXPORT_DIR, progress=None,
+                 cancel: threading.Event | None = None) -> tuple:
+    """Записать продажи за период во временный файл CSV/JSONL (см. EXPORT_FORMATS).
+
+    progress(готово дней, всего дней, строк) сообщает о ходе записи; установленный
+    cancel прерывает её исключением ExportCancelled. Возвращает (путь к файлу,
+    число строк); файл удаляет вызывающий.
+    """
+    fd, path = tempfile.mkstemp(prefix='export_', suffix=f'.{fmt}', dir=directory)
+    os.close(fd)
+    opener = gzip.open if fmt.endswith('.gz') else open
+    rows = 0
+
+    def on_day(done: int, total: int) -> None:
+        if cancel is not None and cancel.is_set():
+            raise ExportCancelled()
+        if progress:
+            progress(done, total, rows)
+
+    try:
+        with opener(path, 'wt', encoding='utf-8', newline='') as f:
+            if fmt.startswith('csv'):
+                writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+                writer.writeheader()
+                for row in iter_export_rows(storage, start, end, on_day):
+                    writer.writerow(row)
+                    rows += 1
+            else:
+                for row in iter_export_rows(storage, start, end, on_day):
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                    rows += 1
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, rows
+
+
+class ExportJob:
+    """Задача экспорта руководителя: параметры, состояние и ход выполнения"""
+
+    def __init__(self, user_id: int, fmt: str, start: date, end: date, message=None):
+        self.user_id = user_id
+        self.fmt = fmt
+        self.start = start
+        self.end = end
+        self.message = message  # сообщение, в котором показывается прогресс
+        self.status = 'queued'  # queued | running | done | failed | cancelled
+        self.days_done = 0
+        self.days_total = 0
+        self.rows = 0
+        self.path = None
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    def on_progress(self, done: int, total: int, rows: int) -> None:
+        """Вызывается из потока экспорта"""
+        self.days_done, self.days_total, self.rows = done, total, rows
+
+
+class ExportJobQueue:
+    """Очередь фоновых экспортов: не больше workers задач одновременно
+    и не больше одной активной задачи на пользователя.
+
+    Файл пишется в собственном пуле потоков, чтобы большие выгрузки не
+    занимали пул хранилища. Пока задача выполняется, report(job) вызывается
+    раз в progress_interval секунд; по завершении (успех, ошибка или отмена)
+    вызывается finish(job), после чего файл удаляется.
+    """
+
+    def __init__(self, storage: SalesStorage, report, finish, workers: int = EXPORT_WORKERS,
+                 progress_interval: float = EXPORT_PROGRESS_INTERVAL):
+        self.storage = storage
+        self.report = report
+        self.finish = finish
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.executor = None
+        self._queue = asyncio.Queue()
+        self._active = {}  # user_id -> ExportJob
+        self._tasks = []
+
+    def active(self, user_id: int) -> ExportJob | None:
+        return self._active.get(user_id)
+
+    def position(self, job: ExportJob) -> int:
+        """Место задачи в очереди (с 1; 0 — уже выполняется)"""
+        if job.status != 'queued':
+            return 0
+        queued = [other for other in self._active.values() if other.status == 'queued']
+        return queued.index(job) + 1 if job in queued else 0
+
+    def submit(self, job: ExportJob) -> bool:
+        """Поставить задачу в очередь (False — у пользователя уже есть активная)"""
+        if job.user_id in self._active:
+            return False
+        self._active[job.user_id] = job
+        self._queue.put_nowait(job)
+        return True
+
+    def cancel(self, user_id: int) -> ExportJob | None:
+        job = self._active.get(user_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.status == 'queued':
+            # Из очереди задача уйдёт сама, но новая может быть поставлена сразу
+            job.status = 'cancelled'
+            del self._active[user_id]
+        return job
+
+    async def _report_loop(self, job: ExportJob) -> None:
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await self.report(job)
+            except Exception as e:
+                logger.warning(f"Прогресс экспорта не обновлён: {e}")
+
+    async def _run(self, job: ExportJob) -> None:
+        loop = asyncio.get_running_loop()
+        job.status = 'running'
+        reporter = asyncio.create_task(self._report_loop(job))
+        try:
+            job.path, job.rows = await loop.run_in_executor(
+                self.executor,
+                partial(write_export, self.storage, job.fmt, job.start, job.end,
+                        progress=job.on_progress, cancel=job.cancel_event)
+            )
+            job.status = 'done'
+        except ExportCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            logger.error(f"Ошибка экспорта для {job.user_id}: {e}")
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            reporter.cancel()
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status != 'cancelled':
+                    await self._run(job)
+                await self.finish(job)
+            except Exception as e:
+                logger.error(f"Ошибка доставки экспорта для {job.user_id}: {e}")
+            finally:
+                if self._active.get(job.user_id) is job:
+                    del self._active[job.user_id]
+                if job.path and os.path.exists(job.path):
+                    os.remove(job.path)
+
+    def start(self) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='export')
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Отменить незавершённые экспорты и остановить обработчиков"""
+        for job in self._active.values():
+            job.cancel_event.set()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self.executor:
+            self.executor.shutdown(wait=True)
+
+
+# ============================================
+# Миграция файлов статистики
+# ============================================
+def migrate_stats_file(file_path: str) -> bool:
+    """Перевести старые ключи файла статистики на ключи подтарифов.
+
+    Выполняется в пуле процессов; исходный файл сохраняется рядом как .backup.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        changed = False
+        for user_data in data.values():
+            new_sales = {}
+            for key, value in user_data.get('sales', {}).items():
+                new_key = key
+                if key not in TARIFF_CATALOG.known_keys:
+                    # Старый ключ вида "тариф_человеческое_название", затем без учёта регистра
+                    new_key = TARIFF_CATALOG.aliases.get(key) or TARIFF_CATALOG.legacy_key(key) or key
+                    changed = changed or new_key != key
+                new_sales[new_key] = new_sales.get(new_key, 0) + value
+            user_data['sales'] = new_sales
+
+        if changed:
+            try:
+                shutil.copyfile(file_path, f"{file_path}.backup")
+            except OSError:
+                logger.warning(f"Не удалось создать backup для {file_path}")
+            write_stats_file(file_path, data)
+            logger.info(f"Файл мигрирован: {file_path}")
+        return changed
+
+    except Exception as e:
+        logger.error(f"Ошибка при обработке файла {file_path}: {e}")
+        return False
+
+
+# ============================================
+# Исходящие запросы к Telegram
+# ============================================
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до свободного токена (0 — можно сейчас)"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.updated:
+            # Пауза после RetryAfter ещё не закончилась
+            return self.updated - now + max(0.0, 1 - self.tokens) / self.rate
+        return max(0.0, 1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (ответ RetryAfter)"""
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Планировщик всех запросов бота к Telegram (подключается как rate_limiter).
+
+    Запрос ждёт токен ведра своего чата, затем — токен общего ведра. Общее
+    ведро выдаётся по приоритету (PRIORITY_INTERACTIVE раньше PRIORITY_BULK,
+    внутри класса — по порядку), поэтому ответы на нажатия не стоят за
+    выгрузками. RetryAfter ставит ведро чата (или общее) на паузу на
+    указанное время, и запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: float = OUTBOUND_CHAT_BURST, max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}    # chat_id -> TokenBucket
+        self._chat_locks = defaultdict(asyncio.Lock)  # порядок запросов внутри чата
+        self._waiting = []  # куча (приоритет, номер) ожидающих общего токена
+        self._counter = itertools.count()
+        self._condition = None
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        self._condition = asyncio.Condition()
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+        self._chat_locks.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire_global(self, priority: int) -> None:
+        ticket = (priority, next(self._counter))
+        async with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            self._condition.notify_all()
+            try:
+                while True:
+                    if self._waiting[0] == ticket:
+                        delay = self.global_bucket.delay()
+                        if delay <= 0:
+                            heapq.heappop(self._waiting)
+                            self.global_bucket.take()
+                            return
+                        try:
+                            await asyncio.wait_for(self._condition.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._condition.wait()
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self._condition.notify_all()
+
+    async def _acquire(self, chat_id, priority: int) -> None:
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id)
+            async with self._chat_locks[chat_id]:
+                while (delay := bucket.delay()) > 0:
+                    await asyncio.sleep(delay)
+                bucket.take()
+        await self._acquire_global(priority)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        for attempt in itertools.count():
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Лимит Telegram ({endpoint}, чат {chat_id}): пауза {seconds:.0f} с")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(seconds)
+                else:
+                    self.global_bucket.pause(seconds)
+                if attempt >= self.max_retries:
+                    raise
+                self.retries += 1
+
+
+# ============================================
+# Параллельная обработка обновлений
+# ============================================
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей — параллельно (до max_concurrent_updates),
+    обновления одного пользователя — строго в порядке поступления.
+
+    Порядок держится в do_process_update (process_update библиотеки не
+    переопределяется): первое обновление пользователя занимает слот семафора
+    и, выполнив себя, выполняет по очереди его обновления, пришедшие за это
+    время. Остальные лишь встают в очередь пользователя и сразу освобождают
+    слот, поэтому нажатия одного пользователя не занимают места, нужные остальным.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}  # user_id -> очередь корутин, ожидающих выполнения
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await coroutine
+            return
+
+        queue = self._queues.get(user.id)
+        if queue is not None:
+            # Выполнит задача, которая уже обрабатывает этого пользователя
+            queue.append(coroutine)
+            return
+
+        queue = self._queues[user.id] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception as e:
+                    logger.error(f"Ошибка обработки обновления пользователя {user.id}: {e}")
+        finally:
+            del self._queues[user.id]
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ============================================
+# Приём обновлений через вебхук
+# ============================================
+class WebhookServer:
+    """Встроенный HTTP сервер вебхука на asyncio, без внешних зависимостей.
+
+    Принимает POST на path с JSON обновления. Если задан secret, заголовок
+    X-Telegram-Bot-Api-Secret-Token должен совпасть с ним, иначе 403.
+    Разобранное тело передаётся в handler(payload); 200 отвечается после того,
+    как handler принял обновление, поэтому при ошибке Telegram повторит доставку.
+    Одно соединение — один запрос (Connection: close), так что сервер
+    одинаково работает напрямую и за обратным прокси.
+    """
+
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 408: 'Request Timeout', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+
+    def __init__(self, handler, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 max_body: int = WEBHOOK_MAX_BODY, read_timeout: float = WEBHOOK_READ_TIMEOUT):
+        self.handler = handler
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self._server = None
+        self._connections = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        # при port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Вебхук слушает {self.listen}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        """Перестать принимать соединения и дождаться начатых запросов"""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        if self._connections:
+            await asyncio.wait(self._connections)
+        self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            try:
+                status = await asyncio.wait_for(self._handle(reader), self.read_timeout)
+            except asyncio.TimeoutError:
+                status = 408
+            except (ValueError, asyncio.IncompleteReadError):
+                status = 400
+            except Exception as e:
+                logger.error(f"Ошибка обработки запроса вебхука: {e}")
+                status = 500
+            writer.write(f"HTTP/1.1 {status} {self.REASONS[status]}\r\n"
+                         f"Content-Length: 0\r\nConnection: close\r\n\r\n".encode('ascii'))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def _handle(self, reader: asyncio.StreamReader) -> int:
+        """Прочитать запрос и вернуть код ответа"""
+        method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if target.split('?', 1)[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if self.secret and not hmac.compare_digest(
+                headers.get('x-telegram-bot-api-secret-token', '').encode(), self.secret.encode()):
+            return 403
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            return 413
+        payload = json.loads(await reader.readexactly(length))
+        if not isinstance(payload, dict):
+            return 400
+        await self.handler(payload)
+        return 200
+
+
+# ============================================
+# Работа без Telegram
+# ============================================
+class OfflineRequest(BaseRequest):
+    """Транспорт Bot API без сети: через него настоящие обработчики работают без Telegram.
+
+    Запросы запоминаются в calls и выводятся в лог, ответы собираются на месте:
+    getMe — бот-заглушка, send*/edit* в чат — сообщение в этом чате, остальное — True.
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Offline', 'username': 'offline_bot'}
+
+    def __init__(self):
+        self.calls = []  # (метод Bot API, параметры)
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data=None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE) -> tuple:
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+        text = params.get('text') or params.get('caption') or ''
+        logger.info(f"→ {endpoint} {params.get('chat_id', '')}: {text}")
+
+        if endpoint == 'getMe':
+            result = self.BOT_USER
+        elif endpoint.startswith(('send', 'edit')) and 'chat_id' in params:
+            result = {'message_id': params.get('message_id') or next(self._message_ids),
+                      'date': int(time.time()), 'chat': {'id': params['chat_id'], 'type': 'private'},
+                      'from': self.BOT_USER, 'text': text}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+# ============================================
+# Готовые клавиатуры
+# ============================================
+class KeyboardRegistry:
+    """Клавиатуры, собранные заранее и общие для всех пользователей.
+
+    Главные меню ролей и подменю тарифов собираются из справочника тарифов один
+    раз и пересобираются, когда reload_tariff_catalog() подменяет TARIFF_CATALOG.
+    Выбор дней, месяцев и готовых периодов запоминается для последнего списка
+    периодов (или дня): format_date вызывается только при смене списка.
+    InlineKeyboardMarkup в PTB неизменяем, поэтому один объект отдаётся всем.
+    """
+
+    # Строки меню после кнопок тарифов: (подпись, callback_data)
+    MANAGER_ROWS = (
+        (("📊 Статистика за день", "stats_daily"), ("📈 Общая статистика", "stats_total")),
+        (("📅 Просмотр по дням", "view_days"), ("📆 Просмотр по месяцам", "view_months")),
+        (("🗓 За период", "view_range"), ("🏆 Рейтинг", "top_month_sales")),
+        (("🧮 Калькулятор", "calculator"),),
+    )
+    HEAD_ROWS = (
+        (("📊 Статистика за день", "stats_daily"), ("📈 Общая статистика", "stats_total")),
+        (("📅 Просмотр по дням", "view_days"), ("📆 Просмотр по месяцам", "view_months")),
+        (("🗓 Статистика за период", "view_range"), ("🏆 Рейтинг", "top_month_sales")),
+        (("👥 Управление менеджерами", "manage_managers"), ("🔄 Сброс статистики", "reset_stats")),
+        (("📤 Экспорт данных", "export_data"), ("🧮 Калькулятор", "calculator")),
+    )
+    EXPORT_ROWS = (
+        (("📄 CSV", "expfmt_csv"), ("📄 CSV (gzip)", "expfmt_csv.gz")),
+        (("🧾 JSONL", "expfmt_jsonl"), ("🧾 JSONL (gzip)", "expfmt_jsonl.gz")),
+        (("◀️ Назад", "back_to_main"),),
+    )
+
+    def __init__(self):
+        self._catalog = None
+        self._menus = {}
+        self._submenus = {}
+        self._pickers = {}  # вид -> (версия, клавиатура)
+        self.export_formats = InlineKeyboardMarkup(self._rows(self.EXPORT_ROWS))
+
+    @staticmethod
+    def _rows(rows) -> list:
+        return [[InlineKeyboardButton(text, callback_data=data) for text, data in row] for row in rows]
+
+    def _refresh(self) -> None:
+        """Пересобрать меню, если справочник тарифов сменился"""
+        catalog = TARIFF_CATALOG
+        if catalog is self._catalog:
+            return
+        buttons = [InlineKeyboardButton(info.get('button', info.get('name', key)), callback_data=f"tariff_{key}")
+                   for key, info in catalog.tariffs.items()]
+        tariff_rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        self._menus = {
+            'manager': InlineKeyboardMarkup(tariff_rows + self._rows(self.MANAGER_ROWS)),
+            'head': InlineKeyboardMarkup(self._rows(self.HEAD_ROWS)),
+        }
+        self._submenus = {}
+        for key, info in catalog.tariffs.items():
+            if info.get('submenu'):
+                keyboard = [[InlineKeyboardButton(sub_name, callback_data=sub_key)]
+                            for sub_key, sub_name in info['submenu'].items()]
+                keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
+                self._submenus[key] = InlineKeyboardMarkup(keyboard)
+        self._catalog = catalog
+
+    def main_menu(self, role: str) -> InlineKeyboardMarkup:
+        self._refresh()
+        return self._menus['manager' if role == 'manager' else 'head']
+
+    def tariff_submenu(self, tariff_key: str) -> InlineKeyboardMarkup | None:
+        """Подменю тарифа или None, если подтарифов нет"""
+        self._refresh()
+        return self._submenus.get(tariff_key)
+
+    def _picker(self, kind, version, build) -> InlineKeyboardMarkup:
+        cached = self._pickers.get(kind)
+        if cached is None or cached[0] != version:
+            cached = (version, InlineKeyboardMarkup(build()))
+            self._pickers[kind] = cached
+        return cached[1]
+
+    def day_picker(self, days: list) -> InlineKeyboardMarkup:
+        def build():
+            keyboard = [[InlineKeyboardButton(f"📅 {format_date(day, 'd MMMM yyyy', locale='ru')}",
+                                              callback_data=f"day_{day.isoformat()}")] for day in days]
+            keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
+            return keyboard
+        return self._picker('days', tuple(days), build)
+
+    def month_picker(self, months: list) -> InlineKeyboardMarkup:
+        def build():
+            keyboard = [[InlineKeyboardButton(f"📆 {format_date(month, 'LLLL yyyy', locale='ru')}",
+                                              callback_data=f"month_{month.strftime('%Y-%m')}")] for month in months]
+            keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
+            return keyboard
+        return self._picker('months', tuple(months), build)
+
+    def range_picker(self, today: date) -> InlineKeyboardMarkup:
+        def build():
+            keyboard = [[InlineKeyboardButton(title, callback_data=f"range_{start.isoformat()}_{end.isoformat()}")]
+                        for title, start, end in range_presets(today)]
+            keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
+            return keyboard
+        return self._picker('range', today, build)
+
+    def export_picker(self, fmt: str, today: date) -> InlineKeyboardMarkup:
+        def build():
+            keyboard = [[InlineKeyboardButton(title, callback_data=f"exp_{fmt}_{start.isoformat()}_{end.isoformat()}")]
+                        for title, start, end in range_presets(today)]
+            keyboard.append([InlineKeyboardButton("🗄 За всё время", callback_data=f"exp_{fmt}_all")])
+            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="export_data")])
+            return keyboard
+        return self._picker(('export', fmt), today, build)
+
 
 class SalesBot:
-    def __init__(self, token: str):
+    def __init__(self, token: str, request: BaseRequest | None = None):
         self.token = token
-        self.application = Application.builder().token(token).build()
-        self.sales_data = {}
+        builder = (
+            Application.builder()
+            .token(token)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .rate_limiter(OutboundScheduler())
+            .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        )
+        if request is not None:
+            # Свой транспорт Bot API (OfflineRequest — локальная проверка без Telegram)
+            builder.request(request)
+        self.application = builder.build()
 
         # Регистрация обработчиков (добавлены /daystats и /monthstats)
         handlers = [
@@ -128,129 +3239,134 @@ class SalesBot:
             CommandHandler("monthstats", self.monthstats),
             CommandHandler("days", self.days_command),  # Новая команда - просмотр по дням
             CommandHandler("months", self.months_command),  # Новая команда - просмотр по месяцам
+            CommandHandler("range", self.range_command),  # Статистика за произвольный период
+            CommandHandler("top", self.top_command),  # Рейтинг менеджеров и тарифов
             CommandHandler("report", self.report),
             CommandHandler("help", self.help_command),
             CommandHandler("id", self.get_id),
             CommandHandler("export", self.export_data),
+            CommandHandler("export_status", self.export_status),
+            CommandHandler("export_cancel", self.export_cancel),
             CallbackQueryHandler(self.button_handler)
         ]
 
         for handler in handlers:
-            self.application.add_handler(handler)
-
-        self.ensure_directories()
-        self.migrate_old_data()
-
-    def ensure_directories(self) -> None:
-        """Создает необходимые директории для хранения данных"""
-        directories = ['data/daily', 'data/monthly', 'data/backups']
-        for directory in directories:
-            os.makedirs(directory, exist_ok=True)
-            logger.info(f"Директория создана/проверена: {directory}")
-
-    def migrate_old_data(self) -> None:
-        """Миграция старых ключей статистики (оставил твою логику)"""
-        logger.info("Запуск миграции старых ключей статистики...")
-
-        # Собираем все допустимые ключи
-        expected_keys = set(TARIFFS.keys())
-        for tariff_info in TARIFFS.values():
-            if tariff_info.get('submenu'):
-                expected_keys.update(tariff_info['submenu'].keys())
-
-        # Создаем маппинг для преобразования старых ключей
-        key_mapping = {}
-        for tariff_key, tariff_info in TARIFFS.items():
-            submenu = tariff_info.get('submenu') or {}
-            for sub_key, human_name in submenu.items():
-                # Старые ключи вида "тариф_человеческое_название"
-                old_key = f"{tariff_key}_{human_name}"
-                key_mapping[old_key] = sub_key
-                key_mapping[old_key.strip()] = sub_key
-
-        def process_file(file_path: str) -> bool:
-            """Обрабатывает один файл статистики"""
-            if not os.path.exists(file_path):
-                return False
-
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                changed = False
-                for user_data in data.values():
-                    sales = user_data.get('sales', {})
-                    new_sales = {}
-
-                    for key, value in sales.items():
-                        if key in expected_keys:
-                            new_sales[key] = new_sales.get(key, 0) + value
-                        elif key in key_mapping:
-                            new_key = key_mapping[key]
-                            new_sales[new_key] = new_sales.get(new_key, 0) + value
-                            changed = True
-                        else:
-                            # Попытка автоматического преобразования
-                            new_key = self._auto_convert_key(key)
-                            if new_key and new_key in expected_keys:
-                                new_sales[new_key] = new_sales.get(new_key, 0) + value
-                                changed = True
-                            else:
-                                new_sales[key] = new_sales.get(key, 0) + value
-
-                    user_data['sales'] = new_sales
-
-                if changed:
-                    # Создаем backup
-                    backup_path = f"{file_path}.backup"
-                    try:
-                        if os.path.exists(backup_path):
-                            os.remove(backup_path)
-                        os.rename(file_path, backup_path)
-                    except OSError:
-                        logger.warning(f"Не удалось создать backup для {file_path}")
-
-                    # Сохраняем обновленные данные
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
-
-                    logger.info(f"Файл мигрирован: {file_path}")
-
-                return changed
-
-            except Exception as e:
-                logger.error(f"Ошибка при обработке файла {file_path}: {e}")
-                return False
+            self.application.add_handler(handler)
 
-        # Обрабатываем все JSON файлы в директориях
-        for folder in ['data/daily', 'data/monthly']:
-            if os.path.exists(folder):
-                for filename in os.listdir(folder):
-                    if filename.endswith('.json') and not filename.endswith('.backup'):
-                        file_path = os.path.join(folder, filename)
-                        process_file(file_path)
+        self.ensure_directories()
+        self.instance_lock = acquire_instance_lock()
+
+        # Весь файловый ввод-вывод выполняется в отдельном пуле потоков
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='storage-io')
+        self.storage = create_storage()
+        self.aggregates = AggregateStore(self.storage, self.io_executor)
+        self.writer = GroupCommitWriter(self.storage, self.aggregates, self.io_executor)
+        self.sessions = SessionStore(self.io_executor)
+        self.data_versions = DataVersions()
+        self.writer.listeners.append(self.data_versions.on_commit)
+        self.prefix_sums = PrefixSumIndex(self.storage, self.aggregates, self.io_executor)
+        self.writer.listeners.append(self.prefix_sums.on_commit)
+        self.stats_engine = StatsEngine(self.storage, self.aggregates, self.data_versions, self.io_executor,
+                                        prefix_sums=self.prefix_sums)
+        self.leaderboard = Leaderboard(self.stats_engine)
+        self.writer.listeners.append(self.leaderboard.on_commit)
+        self.render_cache = RenderCache()
+        self.keyboards = KeyboardRegistry()
+        self.exports = ExportJobQueue(self.storage, self._report_export, self._finish_export)
+        self.migration_task = None
+
+    async def _post_init(self, application: Application) -> None:
+        """Миграция данных и запуск фоновой записи агрегатов вместе с приложением"""
+        pending = await self._io(self._pending_migrations)
+        if not pending:
+            await self._io(self.storage.bootstrap)
+        self.aggregates.start()
+        self.writer.start()
+        self.sessions.start()
+        self.exports.start()
+        if pending:
+            # Хранилище готовится после миграции, чтобы не импортировать старые ключи
+            self.migration_task = asyncio.create_task(self.migrate_old_data(pending))
+        # Данные локали для дат подгружаются в фоне, до первого нажатия
+        asyncio.get_running_loop().run_in_executor(self.io_executor, _load_babel)
+        logger.info(f"Бот готов к приёму обновлений: {(time.perf_counter() - STARTUP_STARTED) * 1000:.0f} мс от запуска")
+
+    async def _post_shutdown(self, application: Application) -> None:
+        """Сброс несохранённых агрегатов и сессий при остановке"""
+        if self.migration_task and not self.migration_task.done():
+            # Незавершённая миграция повторится при следующем запуске
+            self.migration_task.cancel()
+        await self.exports.stop()
+        await self.writer.stop()
+        await self.aggregates.stop()
+        await self.sessions.stop()
+        await self._io(self.storage.close)
+        self.io_executor.shutdown(wait=True)
+        self.instance_lock.close()
+
+    async def _io(self, func, *args, **kwargs):
+        """Выполнить блокирующую операцию хранилища в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, partial(func, *args, **kwargs))
 
-        logger.info("Миграция данных завершена")
+    def ensure_directories(self) -> None:
+        """Создает необходимые директории для хранения данных"""
+        directories = ['data/daily', 'data/monthly', 'data/backups', EVENTS_DIR, EXPORT_DIR]
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+            logger.info(f"Директория создана/проверена: {directory}")
 
-    def _auto_convert_key(self, key: str) -> str | None:
-        """Автоматическое преобразование ключа (оставил как было)"""
-        if '_' not in key:
-            return None
+    @staticmethod
+    def _pending_migrations() -> list:
+        """Каталоги статистики со старой версией формата (читаются только метки).
 
-        parts = key.split('_', 1)
-        if len(parts) != 2:
-            return None
+        Пустой каталог сразу получает метку текущей версии.
+        """
+        pending = []
+        for folder in ['data/daily', 'data/monthly']:
+            if read_schema_version(folder) >= DATA_SCHEMA_VERSION:
+                continue
+            if any(filename.endswith('.json') for filename in os.listdir(folder)):
+                pending.append(folder)
+            else:
+                write_schema_version(folder)
+        return pending
 
-        tariff_key, suffix = parts
-        if tariff_key not in TARIFFS:
-            return None
+    async def migrate_old_data(self, folders: list) -> None:
+        """Однократная миграция старых ключей статистики в пуле процессов.
 
-        submenu = TARIFFS[tariff_key].get('submenu') or {}
-        for sub_key, human_name in submenu.items():
-            if human_name.lower() == suffix.lower():
-                return sub_key
+        Запускается в фоне, не задерживая старт; после неё готовится хранилище
+        и счётчики в памяти перечитываются. Метка версии ставится каталогу,
+        только когда все его файлы обработаны.
+        """
+        logger.info("Запуск миграции старых ключей статистики...")
+        files = {folder: [os.path.join(folder, filename) for filename in
+                          await self._io(os.listdir, folder)
+                          if filename.startswith('sales_') and filename.endswith('.json')]
+                 for folder in folders}
+        total = sum(len(paths) for paths in files.values())
+        done = migrated = 0
+
+        loop = asyncio.get_running_loop()
+        pool = ProcessPoolExecutor(max_workers=MIGRATION_WORKERS)
+        try:
+            for folder, paths in files.items():
+                futures = [loop.run_in_executor(pool, migrate_stats_file, path) for path in paths]
+                for future in asyncio.as_completed(futures):
+                    migrated += await future
+                    done += 1
+                    if done == total or done % max(1, total // 10) == 0:
+                        logger.info(f"Миграция: обработано {done}/{total} файлов, изменено {migrated}")
+                await self._io(write_schema_version, folder)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
-        return None
+        logger.info("Миграция данных завершена")
+        await self._io(self.storage.bootstrap)
+        self.aggregates.reload()
+        self.data_versions.invalidate_all()
+        self.prefix_sums.invalidate()
+        self.leaderboard.invalidate()
 
     def get_user_role(self, username: str | None) -> str | None:
         """Определение роли пользователя по username"""
@@ -266,6 +3382,17 @@ class SalesBot:
         else:
             return None
 
+    async def get_session(self, user_id: int) -> dict | None:
+        """Сессия пользователя из реестра; роль сверяется с текущим ACCESS_CONFIG"""
+        session = await self.sessions.get(user_id)
+        if not session:
+            return None
+        role = self.get_user_role(session.get('username'))
+        if not role:
+            return None
+        session['role'] = role
+        return session
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /start — оставлена твоя логика, добавлено компактное меню"""
         user = update.effective_user
@@ -277,49 +3404,29 @@ class SalesBot:
             await update.message.reply_text("❌ Доступ запрещен. Обратитесь к руководителю.")
             return
 
-        # Инициализация данных пользователя
-        if user.id not in self.sales_data:
-            self.sales_data[user.id] = {
+        # Инициализация данных пользователя (профиль обновляется при каждом /start)
+        session = await self.sessions.get(user.id)
+        if (not session or session.get('username') != user.username
+                or session.get('full_name') != user.full_name or session.get('role') != role):
+            await self.sessions.save(user.id, {
                 'username': user.username,
                 'full_name': user.full_name,
                 'role': role,
-                'sales': {}
-            }
+                'sales': session.get('sales', {}) if session else {}
+            })
 
         await self.show_main_menu(update, user.id, role, is_new_message=True)
 
-    async def show_main_menu(self, update, user_id: int, role: str, is_new_message: bool = False) -> None:
-        """Отображение главного меню — сделал кнопки более компактными (по 2 в строке где возможно)"""
-        if role == 'manager':
-            keyboard = [
-                [InlineKeyboardButton("📱 МТС Риил", callback_data="tariff_mts_real"),
-                 InlineKeyboardButton("📶 МТС Больше", callback_data="tariff_mts_more")],
-                [InlineKeyboardButton("⚡ МТС Супер", callback_data="tariff_mts_super"),
-                 InlineKeyboardButton("🛡️ Мембрана", callback_data="tariff_membrane")],
-                [InlineKeyboardButton("🔍 Яндекс Поиск", callback_data="tariff_yandex_search"),
-                 InlineKeyboardButton("🛒 Яндекс X5", callback_data="tariff_yandex_x5")],
-                [InlineKeyboardButton("👶 Яндекс Детям", callback_data="tariff_yandex_kids")],
-                [InlineKeyboardButton("📊 Статистика за день", callback_data="stats_daily"),
-                 InlineKeyboardButton("📈 Общая статистика", callback_data="stats_total")],
-                [InlineKeyboardButton("📅 Просмотр по дням", callback_data="view_days"),
-                 InlineKeyboardButton("📆 Просмотр по месяцам", callback_data="view_months")],
-                [InlineKeyboardButton("🧮 Калькулятор", callback_data="calculator")]
-            ]
-            welcome_text = "🎯 Выберите тариф для учета продажи:"
-        else:
-            keyboard = [
-                [InlineKeyboardButton("📊 Статистика за день", callback_data="stats_daily"),
-                 InlineKeyboardButton("📈 Общая статистика", callback_data="stats_total")],
-                [InlineKeyboardButton("📅 Просмотр по дням", callback_data="view_days"),
-                 InlineKeyboardButton("📆 Просмотр по месяцам", callback_data="view_months")],
-                [InlineKeyboardButton("👥 Управление менеджерами", callback_data="manage_managers"),
-                 InlineKeyboardButton("🔄 Сброс статистики", callback_data="reset_stats")],
-                [InlineKeyboardButton("📤 Экспорт данных", callback_data="export_data"),
-                 InlineKeyboardButton("🧮 Калькулятор", callback_data="calculator")]
-            ]
-            welcome_text = "👑 Панель руководителя:"
+    async def show_main_menu(self, update, user_id: int, role: str, is_new_message: bool = False,
+                             notice: str | None = None) -> None:
+        """Отображение главного меню — сделал кнопки более компактными (по 2 в строке где возможно).
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        notice (подтверждение продажи, сброса) выводится над меню в том же сообщении.
+        """
+        reply_markup = self.keyboards.main_menu(role)
+        welcome_text = "🎯 Выберите тариф для учета продажи:" if role == 'manager' else "👑 Панель руководителя:"
+        if notice:
+            welcome_text = f"{notice}\n\n{welcome_text}"
 
         if is_new_message or isinstance(update, Update):
             await update.message.reply_text(welcome_text, reply_markup=reply_markup)
@@ -330,46 +3437,25 @@ class SalesBot:
     # НОВЫЕ ФУНКЦИИ: ПРОСМОТР ПО ДНЯМ И МЕСЯЦАМ
     # ============================================
 
-    def get_available_days(self) -> list:
-        """Получить список доступных дней с статистикой"""
-        days = []
-        pattern = 'data/daily/sales_*.json'
-        for file_path in glob.glob(pattern):
-            filename = os.path.basename(file_path)
-            # Извлекаем дату из имени файла: sales_YYYY-MM-DD.json
-            date_str = filename[6:-5]  # Убираем 'sales_' и '.json'
-            try:
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-                days.append(date_obj)
-            except ValueError:
-                continue
-        return sorted(days, reverse=True)  # Сначала новые даты
+    async def get_available_days(self, limit: int | None = None) -> list:
+        """Получить список доступных дней с статистикой (сначала новые)"""
+        return await self._io(self.storage.available_days, limit)
 
-    def get_available_months(self) -> list:
-        """Получить список доступных месяцев с статистикой"""
-        months = []
-        pattern = 'data/monthly/sales_*.json'
-        for file_path in glob.glob(pattern):
-            filename = os.path.basename(file_path)
-            # Извлекаем месяц из имени файла: sales_YYYY-MM.json
-            month_str = filename[6:-5]  # Убираем 'sales_' и '.json'
-            try:
-                month_obj = datetime.strptime(month_str + '-01', '%Y-%m-%d').date()
-                months.append(month_obj)
-            except ValueError:
-                continue
-        return sorted(months, reverse=True)  # Сначала новые месяцы
+    async def get_available_months(self, limit: int | None = None) -> list:
+        """Получить список доступных месяцев с статистикой (сначала новые)"""
+        return await self._io(self.storage.available_months, limit)
 
-    def get_stats_for_day(self, day: date, user_id: int | None = None) -> dict:
+    async def get_stats_for_day(self, day: date, user_id: int | None = None) -> PeriodTotals | UserTotals:
         """Получить статистику за конкретный день"""
-        filename = f'data/daily/sales_{day.isoformat()}.json'
-        return self._load_stats_from_file(filename, user_id)
+        return await self.get_totals(day.isoformat(), user_id)
 
-    def get_stats_for_month(self, month: date, user_id: int | None = None) -> dict:
+    async def get_stats_for_month(self, month: date, user_id: int | None = None) -> PeriodTotals | UserTotals:
         """Получить статистику за конкретный месяц"""
-        month_str = month.strftime('%Y-%m')
-        filename = f'data/monthly/sales_{month_str}.json'
-        return self._load_stats_from_file(filename, user_id)
+        return await self.get_totals(month.strftime('%Y-%m'), user_id)
+
+    async def get_stats_for_range(self, start: date, end: date, user_id: int | None = None) -> PeriodTotals | UserTotals:
+        """Получить статистику за дни start..end включительно"""
+        return await self.get_totals(range_period(start, end), user_id)
 
     async def days_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Команда /days - просмотр статистики по дням"""
@@ -378,28 +3464,19 @@ class SalesBot:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        user_data = await self.get_session(user_id)
+        if not user_data:
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        available_days = self.get_available_days()
+        available_days = await self.get_available_days(10)
         if not available_days:
             await update.message.reply_text("📭 Нет данных по дням")
             return
 
-        user_data = self.sales_data[user_id]
         role = user_data['role']
 
-        # Создаем клавиатуру с днями
-        keyboard = []
-        for day in available_days[:10]:  # Показываем последние 10 дней
-            day_str = format_date(day, "d MMMM yyyy", locale="ru")
-            callback_data = f"day_{day.isoformat()}"
-            keyboard.append([InlineKeyboardButton(f"📅 {day_str}", callback_data=callback_data)])
-
-        keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.keyboards.day_picker(available_days)
         
         if role == 'head':
             message = "📅 Выберите день для просмотра общей статистики:"
@@ -415,28 +3492,19 @@ class SalesBot:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        user_data = await self.get_session(user_id)
+        if not user_data:
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        available_months = self.get_available_months()
+        available_months = await self.get_available_months(12)
         if not available_months:
             await update.message.reply_text("📭 Нет данных по месяцам")
             return
 
-        user_data = self.sales_data[user_id]
         role = user_data['role']
 
-        # Создаем клавиатуру с месяцами
-        keyboard = []
-        for month in available_months[:12]:  # Показываем последние 12 месяцев
-            month_str = format_date(month, "LLLL yyyy", locale="ru")
-            callback_data = f"month_{month.strftime('%Y-%m')}"
-            keyboard.append([InlineKeyboardButton(f"📆 {month_str}", callback_data=callback_data)])
-
-        keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.keyboards.month_picker(available_months)
         
         if role == 'head':
             message = "📆 Выберите месяц для просмотра общей статистики:"
@@ -445,125 +3513,125 @@ class SalesBot:
         
         await update.message.reply_text(message, reply_markup=reply_markup)
 
+    async def _cached_screen(self, view: str, period: str, user_id: int | None, render) -> tuple:
+        """Экран (текст, клавиатура) из кэша или от render() для текущей версии данных периода"""
+        key = (view, period, 'all' if user_id is None else user_id)
+        # Версия берётся до отрисовки: продажа во время неё сделает экран устаревшим
+        version = self.data_versions.version(period)
+        screen = self.render_cache.get(key, version)
+        if screen is None:
+            screen = await render()
+            self.render_cache.put(key, version, screen)
+        return screen
+
+    async def _stats_user(self, user_id: int) -> int | None:
+        """Чью статистику показывать: руководителю — общую (None), менеджеру — его"""
+        user_data = await self.get_session(user_id)
+        return None if user_data['role'] == 'head' else user_id
+
     async def show_day_stats(self, query, day_str: str, user_id: int) -> None:
         """Показать статистику за конкретный день"""
         try:
             day = datetime.strptime(day_str, '%Y-%m-%d').date()
-            stats = self.get_stats_for_day(day, user_id)
-            
-            user_data = self.sales_data[user_id]
-            if user_data['role'] == 'head':
-                stats = self.get_stats_for_day(day)  # Для руководителя - общая статистика
-
-            await self._display_specific_stats(query, stats, day, "day")
         except ValueError:
             await query.edit_message_text("❌ Неверный формат даты")
+            return
+
+        stats_user = await self._stats_user(user_id)
+
+        async def render() -> tuple:
+            stats = await self.get_stats_for_day(day, stats_user)
+            return self._render_specific_stats(stats, day, "day")
+
+        text, reply_markup = await self._cached_screen('day', day.isoformat(), stats_user, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
     async def show_month_stats(self, query, month_str: str, user_id: int) -> None:
         """Показать статистику за конкретный месяц"""
         try:
             month = datetime.strptime(month_str + '-01', '%Y-%m-%d').date()
-            stats = self.get_stats_for_month(month, user_id)
-            
-            user_data = self.sales_data[user_id]
-            if user_data['role'] == 'head':
-                stats = self.get_stats_for_month(month)  # Для руководителя - общая статистика
-
-            await self._display_specific_stats(query, stats, month, "month")
         except ValueError:
             await query.edit_message_text("❌ Неверный формат месяца")
+            return
+
+        stats_user = await self._stats_user(user_id)
+
+        async def render() -> tuple:
+            stats = await self.get_stats_for_month(month, stats_user)
+            return self._render_specific_stats(stats, month, "month")
+
+        text, reply_markup = await self._cached_screen('month', month.strftime('%Y-%m'), stats_user, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
-    async def _display_specific_stats(self, query, stats: dict, period: date, period_type: str) -> None:
-        """Отображение статистики за конкретный период"""
+    def _render_specific_stats(self, stats: PeriodTotals | UserTotals, period: date | tuple, period_type: str) -> tuple:
+        """Отображение статистики за конкретный период (для "range" period — пара дат)"""
         if period_type == "day":
             period_name = format_date(period, "d MMMM yyyy", locale="ru")
             period_text = "день"
+        elif period_type == "range":
+            start, end = period
+            period_name = (f"{format_date(start, 'd MMMM yyyy', locale='ru')} — "
+                           f"{format_date(end, 'd MMMM yyyy', locale='ru')}")
+            period_text = "период"
         else:
             period_name = format_date(period, "LLLL yyyy", locale="ru")
             period_text = "месяц"
 
-        if not stats:
-            message = f"📊 Статистика за {period_name}\n\n📭 Нет данных за этот {period_text}"
-        else:
-            if 'sales' in stats:  # Статистика одного пользователя
-                sales_data = stats.get('sales', {})
-                total_sales = sum(sales_data.values())
-                total_revenue = 0
-                message_lines = [f"📊 Статистика за {period_name}\n\n"]
-
-                sorted_sales = sorted(sales_data.items(), key=lambda x: self.get_display_name(x[0]))
-                for tariff_key, count in sorted_sales:
-                    tariff_name = self.get_display_name(tariff_key)
-                    price = PRICE_MAP.get(tariff_key, 0)
-                    subtotal = price * count
-                    total_revenue += subtotal
-                    message_lines.append(f"• {tariff_name}: {count} продаж (≈ {subtotal} ₽)")
+        if isinstance(stats, UserTotals):  # Статистика одного пользователя
+            message_lines = [f"📊 Статистика за {period_name}\n\n"]
+
+            sorted_sales = sorted(stats.sales.items(), key=lambda x: self.get_display_name(x[0]))
+            for tariff_key, count in sorted_sales:
+                tariff_name = self.get_display_name(tariff_key)
+                subtotal = TARIFF_CATALOG.price(tariff_key) * count
+                message_lines.append(f"• {tariff_name}: {count} продаж (≈ {subtotal} ₽)")
 
-                avg_check = round(total_revenue / total_sales, 2) if total_sales > 0 else 0
-                message_lines.append(f"\n💰 Доход: {total_revenue} ₽")
-                message_lines.append(f"💳 Средний чек: {avg_check} ₽")
-                message_lines.append(f"📈 Всего продаж: {total_sales}")
+            message_lines.append(f"\n💰 Доход: {stats.revenue} ₽")
+            message_lines.append(f"💳 Средний чек: {stats.avg_check} ₽")
+            message_lines.append(f"📈 Всего продаж: {stats.total}")
 
-                message = "\n".join(message_lines)
+            message = "\n".join(message_lines)
 
-            else:  # Общая статистика для руководителя
-                total_all_sales = 0
-                total_all_revenue = 0
-                message_lines = [f"📊 Общая статистика за {period_name}\n\n"]
+        elif not stats.users:
+            message = f"📊 Статистика за {period_name}\n\n📭 Нет данных за этот {period_text}"
 
-                for user_str, user_data in stats.items():
-                    manager_name = user_data.get('full_name', 'Неизвестный')
-                    manager_total = 0
-                    manager_revenue = 0
-                    manager_lines = []
+        else:  # Общая статистика для руководителя
+            message_lines = [f"📊 Общая статистика за {period_name}\n\n"]
 
-                    for tariff_key, count in user_data.get('sales', {}).items():
-                        price = PRICE_MAP.get(tariff_key, 0)
-                        subtotal = price * count
-                        manager_total += count
-                        manager_revenue += subtotal
-                        manager_lines.append(f"   • {self.get_display_name(tariff_key)}: {count}")
-
-                    total_all_sales += manager_total
-                    total_all_revenue += manager_revenue
-                    message_lines.append(f"👤 {manager_name}: {manager_total} продаж (≈ {manager_revenue} ₽)")
-                    message_lines.extend(manager_lines)
-                    message_lines.append("")
-
-                message_lines.append(f"🎯 ОБЩЕЕ КОЛИЧЕСТВО ПРОДАЖ: {total_all_sales}")
-                message_lines.append(f"💰 ОБЩИЙ ДОХОД: {total_all_revenue} ₽")
-                message = "\n".join(message_lines)
+            for user in stats.users.values():
+                manager_name = user.full_name or 'Неизвестный'
+                message_lines.append(f"👤 {manager_name}: {user.total} продаж (≈ {user.revenue} ₽)")
+                for tariff_key, count in user.sales.items():
+                    message_lines.append(f"   • {self.get_display_name(tariff_key)}: {count}")
+                message_lines.append("")
+
+            message_lines.append(f"🎯 ОБЩЕЕ КОЛИЧЕСТВО ПРОДАЖ: {stats.total}")
+            message_lines.append(f"💰 ОБЩИЙ ДОХОД: {stats.revenue} ₽")
+            message = "\n".join(message_lines)
 
         # Кнопки навигации
         keyboard = []
         if period_type == "day":
             keyboard.append([InlineKeyboardButton("📅 К списку дней", callback_data="view_days")])
+        elif period_type == "range":
+            keyboard.append([InlineKeyboardButton("🗓 К выбору периода", callback_data="view_range")])
         else:
             keyboard.append([InlineKeyboardButton("📆 К списку месяцев", callback_data="view_months")])
         keyboard.append([InlineKeyboardButton("◀️ Главное меню", callback_data="back_to_main")])
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        return message, InlineKeyboardMarkup(keyboard)
 
     async def show_days_menu(self, query, user_id: int) -> None:
         """Показать меню выбора дней (inline)"""
-        available_days = self.get_available_days()
+        available_days = await self.get_available_days(10)
         if not available_days:
             await query.edit_message_text("📭 Нет данных по дням")
             return
 
-        user_data = self.sales_data[user_id]
+        user_data = await self.get_session(user_id)
         role = user_data['role']
 
-        keyboard = []
-        for day in available_days[:10]:  # Показываем последние 10 дней
-            day_str = format_date(day, "d MMMM yyyy", locale="ru")
-            callback_data = f"day_{day.isoformat()}"
-            keyboard.append([InlineKeyboardButton(f"📅 {day_str}", callback_data=callback_data)])
-
-        keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.keyboards.day_picker(available_days)
         
         if role == 'head':
             message = "📅 Выберите день для просмотра общей статистики:"
@@ -574,23 +3642,15 @@ class SalesBot:
 
     async def show_months_menu(self, query, user_id: int) -> None:
         """Показать меню выбора месяцев (inline)"""
-        available_months = self.get_available_months()
+        available_months = await self.get_available_months(12)
         if not available_months:
             await query.edit_message_text("📭 Нет данных по месяцам")
             return
 
-        user_data = self.sales_data[user_id]
+        user_data = await self.get_session(user_id)
         role = user_data['role']
 
-        keyboard = []
-        for month in available_months[:12]:  # Показываем последние 12 месяцев
-            month_str = format_date(month, "LLLL yyyy", locale="ru")
-            callback_data = f"month_{month.strftime('%Y-%m')}"
-            keyboard.append([InlineKeyboardButton(f"📆 {month_str}", callback_data=callback_data)])
-
-        keyboard.append([InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_main")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.keyboards.month_picker(available_months)
         
         if role == 'head':
             message = "📆 Выберите месяц для просмотра общей статистики:"
@@ -599,25 +3659,92 @@ class SalesBot:
         
         await query.edit_message_text(message, reply_markup=reply_markup)
 
+    @staticmethod
+    def _parse_range(first: str, last: str, max_days: int | None = RANGE_MAX_DAYS) -> tuple:
+        """Даты диапазона из ввода (ГГГГ-ММ-ДД или ДД.ММ.ГГГГ); ValueError с текстом для пользователя"""
+        def parse(value: str) -> date:
+            for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+                try:
+                    return datetime.strptime(value, fmt).date()
+                except ValueError:
+                    pass
+            raise ValueError(f"❌ Неверный формат даты: {value}")
+
+        start, end = parse(first), parse(last)
+        if start > end:
+            raise ValueError("❌ Начало периода позже его конца")
+        if max_days is not None and (end - start).days >= max_days:
+            raise ValueError(f"❌ Период не может быть длиннее {max_days} дней")
+        return start, end
+
+    async def _range_screen(self, start: date, end: date, user_id: int) -> tuple:
+        stats_user = await self._stats_user(user_id)
+
+        async def render() -> tuple:
+            stats = await self.get_stats_for_range(start, end, stats_user)
+            return self._render_specific_stats(stats, (start, end), "range")
+
+        return await self._cached_screen('range', range_period(start, end), stats_user, render)
+
+    async def range_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Команда /range С ПО - статистика за произвольный период (без аргументов — выбор периода)"""
+        user = update.effective_user
+        if not user:
+            return
+
+        user_id = user.id
+        if not await self.get_session(user_id):
+            await update.message.reply_text("❌ Отправьте /start для начала работы")
+            return
+
+        args = context.args or []
+        if not args:
+            await update.message.reply_text("🗓 Выберите период или отправьте /range С ПО "
+                                            "(например, /range 01.01.2025 31.03.2025):",
+                                            reply_markup=self.keyboards.range_picker(date.today()))
+            return
+        if len(args) != 2:
+            await update.message.reply_text("❌ Использование: /range С ПО, например /range 01.01.2025 31.03.2025")
+            return
+
+        try:
+            start, end = self._parse_range(args[0], args[1])
+        except ValueError as e:
+            await update.message.reply_text(str(e))
+            return
+
+        text, reply_markup = await self._range_screen(start, end, user_id)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+    async def show_range_menu(self, query) -> None:
+        """Показать меню выбора периода (inline)"""
+        await query.edit_message_text("🗓 Выберите период (свой — командой /range С ПО):",
+                                      reply_markup=self.keyboards.range_picker(date.today()))
+
+    async def show_range_stats(self, query, range_str: str, user_id: int) -> None:
+        """Показать статистику за период из callback 'range_С_ПО'"""
+        try:
+            start, end = self._parse_range(*range_str.split('_'))
+        except (TypeError, ValueError):
+            await query.edit_message_text("❌ Неверный период")
+            return
+
+        text, reply_markup = await self._range_screen(start, end, user_id)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
     # ============================================
     # ПРОДОЛЖЕНИЕ СУЩЕСТВУЮЩЕГО КОДА
     # ============================================
 
     async def show_tariff_submenu(self, query, tariff_key: str) -> None:
         """Отображение подменю тарифа (твоя логика)"""
-        tariff_info = TARIFFS.get(tariff_key)
+        tariff_info = TARIFF_CATALOG.tariffs.get(tariff_key)
         if not tariff_info:
             await query.edit_message_text("❌ Тариф не найден")
             return
 
-        if tariff_info['submenu']:
-            keyboard = []
-            for sub_key, sub_name in tariff_info['submenu'].items():
-                keyboard.append([InlineKeyboardButton(sub_name, callback_data=sub_key)])
-
-            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.keyboards.tariff_submenu(tariff_key)
+        if reply_markup:
             await query.edit_message_text(
                 f"🎯 {tariff_info['name']}\nВыберите тип:",
                 reply_markup=reply_markup
@@ -628,12 +3755,11 @@ class SalesBot:
     async def record_sale(self, query, record_key: str, display_name: str | None = None) -> None:
         """Запись продажи (твоя логика)"""
         user_id = query.from_user.id
-        if user_id not in self.sales_data:
+        user_data = await self.get_session(user_id)
+        if not user_data:
             await query.edit_message_text("❌ Сессия устарела. Отправьте /start")
             return
 
-        user_data = self.sales_data[user_id]
-
         # Нормализация ключа
         normalized_key = self.normalize_key(record_key)
         if not display_name:
@@ -643,11 +3769,11 @@ class SalesBot:
         if normalized_key not in user_data['sales']:
             user_data['sales'][normalized_key] = 0
         user_data['sales'][normalized_key] += 1
+        self.sessions.mark_dirty(user_id)
 
-        # Сохранение
+        # Сохранение — одна запись в журнал событий
         try:
-            self.save_daily_sale(user_id, normalized_key)
-            self.save_monthly_sale(user_id, normalized_key)
+            await self.save_sale(user_id, normalized_key)
         except Exception as e:
             logger.error(f"Ошибка сохранения: {e}")
             await query.edit_message_text("❌ Ошибка при сохранении данных")
@@ -655,139 +3781,63 @@ class SalesBot:
 
         current_count = user_data['sales'][normalized_key]
 
-        await query.edit_message_text(
-            f"✅ Продажа записана!\n\n"
-            f"📦 Тариф: {display_name}\n"
-            f"📊 Всего продаж: {current_count}\n\n"
-            f"Продолжайте в том же духе! 💪"
+        # Подтверждение и меню — одно сообщение, без паузы в обработчике
+        await self.show_main_menu(
+            query, user_id, user_data['role'],
+            notice=(f"✅ Продажа записана!\n\n"
+                    f"📦 Тариф: {display_name}\n"
+                    f"📊 Всего продаж: {current_count}\n\n"
+                    f"Продолжайте в том же духе! 💪")
         )
 
-        await asyncio.sleep(2)
-        await self.show_main_menu(query, user_id, user_data['role'])
-
     def normalize_key(self, key: str) -> str:
-        """Нормализация ключа тарифа (твоя логика)"""
-        # Прямое соответствие
-        if key in TARIFFS:
-            return key
-
-        # Поиск в подменю
-        for tariff_info in TARIFFS.values():
-            submenu = tariff_info.get('submenu') or {}
-            if key in submenu:
-                return key
-
-        # Попытка преобразования
-        if '_' in key:
-            parts = key.split('_', 1)
-            if len(parts) == 2:
-                tariff_key, suffix = parts
-                if tariff_key in TARIFFS:
-                    submenu = TARIFFS[tariff_key].get('submenu') or {}
-                    for sub_key, human_name in submenu.items():
-                        if human_name == suffix or human_name.strip() == suffix.strip():
-                            return sub_key
-
-        return key
+        """Нормализация ключа тарифа"""
+        return TARIFF_CATALOG.normalize(key)
 
     def get_display_name(self, tariff_key: str) -> str:
-        """Получение читаемого названия тарифа (твоя таблица)"""
-        display_names = {
-            'mts_real_1month': '📱 МТС Риил (1 Месяц)',
-            'mts_real_subscription': '📱 МТС Риил (Абонемент)',
-            'mts_real': '📱 МТС Риил',
-            'mts_more_1month': '📶 МТС Больше (1 Месяц)',
-            'mts_more_subscription': '📶 МТС Больше (Абонемент)',
-            'mts_more': '📶 МТС Больше',
-            'mts_super': '⚡ МТС Супер',
-            'membrane': '🛡️ Мембрана',
-            'yandex_search': '🔍 Яндекс Поиск',
-            'yandex_x5_new': '🛒 Яндекс Подписка X5 (Новый)',
-            'yandex_x5_returning': '🛒 Яндекс Подписка X5 (Вернувшийся)',
-            'yandex_x5_active': '🛒 Яндекс Подписка X5 (Действующий)',
-            'yandex_x5': '🛒 Яндекс Подписка X5',
-            'yandex_kids_new': '👶 Яндекс Подписка Детям (Новый)',
-            'yandex_kids_returning': '👶 Яндекс Подписка Детям (Вернувшийся)',
-            'yandex_kids_active': '👶 Яндекс Подписка Детям (Действующий)',
-            'yandex_kids': '👶 Яндекс Подписка Детям'
+        """Получение читаемого названия тарифа"""
+        return TARIFF_CATALOG.display_name(tariff_key)
+
+    async def save_sale(self, user_id: int, tariff_key: str) -> None:
+        """Сохранение продажи — одна строка в журнале дня, записанная групповой фиксацией"""
+        now = datetime.now()
+        user_data = await self.get_session(user_id) or {}
+        event = {
+            'ts': now.isoformat(timespec='seconds'),
+            'type': 'sale',
+            'user_id': user_id,
+            'username': user_data.get('username', ''),
+            'full_name': user_data.get('full_name', ''),
+            'tariff': tariff_key
         }
+        await self.writer.submit(event)
+
+    async def _append_reset_event(self, manager_id: str | None, day: date | None = None) -> None:
+        """Запись сброса дневной статистики в журнал (по умолчанию — за сегодня)"""
+        now = datetime.now()
+        user_id = None if manager_id == "all" or not manager_id else int(manager_id)
+        event = {
+            'ts': now.isoformat(timespec='seconds'),
+            'type': 'reset',
+            'scope': 'day',
+            'user_id': user_id
+        }
+        if day and day != now.date():
+            event['day'] = day.isoformat()
+        await self.writer.submit(event)
 
-        normalized_key = self.normalize_key(tariff_key)
-        return display_names.get(normalized_key, normalized_key)
-
-    def save_daily_sale(self, user_id: int, tariff_key: str) -> None:
-        """Сохранение дневной статистики"""
-        today = date.today().isoformat()
-        filename = f'data/daily/sales_{today}.json'
-        self._save_sale_to_file(filename, user_id, tariff_key)
-
-    def save_monthly_sale(self, user_id: int, tariff_key: str) -> None:
-        """Сохранение месячной статистики"""
-        current_month = datetime.now().strftime('%Y-%m')
-        filename = f'data/monthly/sales_{current_month}.json'
-        self._save_sale_to_file(filename, user_id, tariff_key)
-
-    def _save_sale_to_file(self, filename: str, user_id: int, tariff_key: str) -> None:
-        """Общая функция сохранения статистики в файл (твоя логика)"""
-        try:
-            if os.path.exists(filename):
-                with open(filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            else:
-                data = {}
-
-            user_str = str(user_id)
-            if user_str not in data:
-                user_data = self.sales_data.get(user_id, {})
-                data[user_str] = {
-                    'username': user_data.get('username', ''),
-                    'full_name': user_data.get('full_name', ''),
-                    'sales': {}
-                }
-
-            if tariff_key not in data[user_str]['sales']:
-                data[user_str]['sales'][tariff_key] = 0
-
-            data[user_str]['sales'][tariff_key] += 1
-
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-
-        except Exception as e:
-            logger.error(f"Ошибка сохранения в файл {filename}: {e}")
-            raise
-
-    def get_daily_stats(self, user_id: int | None = None) -> dict:
-        """Получение дневной статистики"""
-        today = date.today().isoformat()
-        filename = f'data/daily/sales_{today}.json'
-        return self._load_stats_from_file(filename, user_id)
-
-    def get_monthly_stats(self, user_id: int | None = None, month: str | None = None) -> dict:
-        """Получение месячной статистики"""
-        if not month:
-            month = datetime.now().strftime('%Y-%m')
-        filename = f'data/monthly/sales_{month}.json'
-        return self._load_stats_from_file(filename, user_id)
-
-    def _load_stats_from_file(self, filename: str, user_id: int | None) -> dict:
-        """Загрузка статистики из файла"""
-        if not os.path.exists(filename):
-            return {}
-
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+    async def get_totals(self, period: str, user_id: int | None = None) -> PeriodTotals | UserTotals:
+        """Итоги дня ('YYYY-MM-DD') или месяца ('YYYY-MM') — всех или одного пользователя"""
+        totals = await self.stats_engine.totals(period)
+        return totals if user_id is None else totals.user(user_id)
 
-            if user_id is not None:
-                user_str = str(user_id)
-                return data.get(user_str, {'sales': {}})
-            else:
-                return data
+    async def get_daily_stats(self, user_id: int | None = None) -> PeriodTotals | UserTotals:
+        """Получение дневной статистики (из памяти)"""
+        return await self.get_totals(date.today().isoformat(), user_id)
 
-        except Exception as e:
-            logger.error(f"Ошибка загрузки файла {filename}: {e}")
-            return {}
+    async def get_monthly_stats(self, user_id: int | None = None, month: str | None = None) -> PeriodTotals | UserTotals:
+        """Получение месячной статистики (текущий месяц — из памяти)"""
+        return await self.get_totals(month or datetime.now().strftime('%Y-%m'), user_id)
 
     # -----------------------------
     # Команды: /stats, /daystats, /monthstats
@@ -799,12 +3849,11 @@ class SalesBot:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        if not await self.get_session(user_id):
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        daily_stats = self.get_daily_stats(user_id)
-        await self._display_stats_message(update.message, daily_stats, "сегодня", "день")
+        await self._reply_stats_message(update.message, user_id, "день")
 
     async def daystats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Команда /daystats — отдельный просмотр по дням"""
@@ -813,12 +3862,11 @@ class SalesBot:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        if not await self.get_session(user_id):
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        daily_stats = self.get_daily_stats(user_id)
-        await self._display_stats_message(update.message, daily_stats, "сегодня", "день")
+        await self._reply_stats_message(update.message, user_id, "день")
 
     async def monthstats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Команда /monthstats — отдельный просмотр по месяцу"""
@@ -827,12 +3875,11 @@ class SalesBot:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        if not await self.get_session(user_id):
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        monthly_stats = self.get_monthly_stats(user_id)
-        await self._display_stats_message(update.message, monthly_stats, "текущий месяц", "месяц")
+        await self._reply_stats_message(update.message, user_id, "месяц")
 
     async def report(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Команда /report - общий отчет для руководителя"""
@@ -841,212 +3888,176 @@ class SalesBot:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        user_data = await self.get_session(user_id)
+        if not user_data:
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        user_data = self.sales_data[user_id]
         if user_data['role'] != 'head':
             await update.message.reply_text("❌ Доступ только для руководителя")
             return
 
-        monthly_stats = self.get_monthly_stats()
-        await self._display_report_message(update.message, monthly_stats)
+        async def render() -> tuple:
+            return self._render_report_message(await self.get_monthly_stats())
+
+        text, _ = await self._cached_screen('report', datetime.now().strftime('%Y-%m'), None, render)
+        await update.message.reply_text(text)
 
     # -----------------------------
     # Отображение статистики (с локализацией дат и доходом)
     # -----------------------------
-    async def _display_stats_message(self, message, stats: dict, period_name: str, period_type: str) -> None:
+    @staticmethod
+    def _current_period(period_type: str) -> str:
+        """Текущий период экрана: сегодняшний день или текущий месяц"""
+        return date.today().isoformat() if period_type == "день" else datetime.now().strftime('%Y-%m')
+
+    async def _reply_stats_message(self, message, user_id: int, period_type: str) -> None:
+        """Ответ на /stats, /daystats и /monthstats (день или текущий месяц)"""
+        async def render() -> tuple:
+            if period_type == "день":
+                return self._render_stats_message(await self.get_daily_stats(user_id), "сегодня", period_type)
+            return self._render_stats_message(await self.get_monthly_stats(user_id), "текущий месяц", period_type)
+
+        text, _ = await self._cached_screen('stats_message', self._current_period(period_type), user_id, render)
+        await message.reply_text(text)
+
+    def _render_stats_message(self, stats: UserTotals, period_name: str, period_type: str) -> tuple:
         """Отображение статистики в сообщении (добавлен доход и средний чек, формат дат через babel)"""
-        sales_data = {}
-        if isinstance(stats, dict):
-            sales_data = stats.get('sales', {}) or {}
+        current_date = datetime.now()
+        if period_type == "день":
+            date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
         else:
-            sales_data = {}
-
-        if not sales_data:
-            current_date = datetime.now()
-            if period_type == "день":
-                date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
-            else:
-                date_str = format_date(current_date, "LLLL yyyy", locale="ru")
+            date_str = format_date(current_date, "LLLL yyyy", locale="ru")
 
+        if not stats.sales:
             text = f"📊 Статистика за {period_name} ({date_str})\n\n📭 Продаж еще нет"
         else:
-            total_sales_count = 0
-            total_revenue = 0
             message_lines = []
 
-            sorted_sales = sorted(sales_data.items(), key=lambda x: self.get_display_name(x[0]))
+            sorted_sales = sorted(stats.sales.items(), key=lambda x: self.get_display_name(x[0]))
             for tariff_key, count in sorted_sales:
                 tariff_name = self.get_display_name(tariff_key)
-                price = PRICE_MAP.get(tariff_key, 0)
-                subtotal = price * count
+                subtotal = TARIFF_CATALOG.price(tariff_key) * count
                 message_lines.append(f"• {tariff_name}: {count} продаж (≈ {subtotal} ₽)")
-                total_sales_count += count
-                total_revenue += subtotal
-
-            current_date = datetime.now()
-            if period_type == "день":
-                date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
-            else:
-                date_str = format_date(current_date, "LLLL yyyy", locale="ru")
-
-            avg_check = round(total_revenue / total_sales_count, 2) if total_sales_count > 0 else 0
 
             text = f"📊 Статистика за {period_name} ({date_str})\n\n" + "\n".join(message_lines)
-            text += f"\n\n💰 Доход: {total_revenue} ₽"
-            text += f"\n💳 Средний чек: {avg_check} ₽"
-            text += f"\n\n📈 Всего за {period_type}: {total_sales_count} продаж"
+            text += f"\n\n💰 Доход: {stats.revenue} ₽"
+            text += f"\n💳 Средний чек: {stats.avg_check} ₽"
+            text += f"\n\n📈 Всего за {period_type}: {stats.total} продаж"
 
-        await message.reply_text(text)
+        return text, None
 
-    async def _display_report_message(self, message, monthly_stats: dict) -> None:
+    def _render_report_message(self, monthly_stats: PeriodTotals) -> tuple:
         """Отображение отчета для руководителя (с локализованной датой)"""
-        if not monthly_stats:
-            text = f"📈 Общий отчет за {format_date(datetime.now(), 'LLLL yyyy', locale='ru')}\n\n📭 Продаж за этот месяц еще нет"
+        month_title = format_date(datetime.now(), 'LLLL yyyy', locale='ru')
+        if not monthly_stats.users:
+            text = f"📈 Общий отчет за {month_title}\n\n📭 Продаж за этот месяц еще нет"
         else:
-            total_all_sales = 0
             managers_stats = {}
+            for user in monthly_stats.users.values():
+                managers_stats[user.full_name or 'Неизвестный'] = user.total
 
-            for user_str, user_data in monthly_stats.items():
-                manager_name = user_data.get('full_name', 'Неизвестный')
-                managers_stats[manager_name] = {'total': 0}
-
-                for count in user_data.get('sales', {}).values():
-                    managers_stats[manager_name]['total'] += count
-                    total_all_sales += count
-
-            text = f"📈 Общий отчет за {format_date(datetime.now(), 'LLLL yyyy', locale='ru')}\n\n"
+            text = f"📈 Общий отчет за {month_title}\n\n"
             text += "👥 СТАТИСТИКА ПО МЕНЕДЖЕРАМ:\n\n"
-            for manager, stats in sorted(managers_stats.items()):
-                text += f"👤 {manager}: {stats['total']} продаж\n"
+            for manager, total in sorted(managers_stats.items()):
+                text += f"👤 {manager}: {total} продаж\n"
 
-            text += f"\n🎯 ОБЩЕЕ КОЛИЧЕСТВО ПРОДАЖ: {total_all_sales}"
+            text += f"\n🎯 ОБЩЕЕ КОЛИЧЕСТВО ПРОДАЖ: {monthly_stats.total}"
 
-        await message.reply_text(text)
+        return text, None
 
     # -----------------------------
     # Inline / callback статистика (обновлена только по датам)
     # -----------------------------
     async def show_daily_stats(self, query, user_id: int) -> None:
         """Показать дневную статистику в inline режиме"""
-        daily_stats = self.get_daily_stats(user_id)
-        await self._display_stats_inline(query, daily_stats, "сегодня", "день")
+        async def render() -> tuple:
+            return self._render_stats_inline(await self.get_daily_stats(user_id), "сегодня", "день")
+
+        text, reply_markup = await self._cached_screen('stats_inline', self._current_period("день"), user_id, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
     async def show_total_stats(self, query, user_id: int) -> None:
         """Показать общую статистику в inline режиме"""
-        monthly_stats = self.get_monthly_stats(user_id)
-        await self._display_stats_inline(query, monthly_stats, "текущий месяц", "месяц")
+        async def render() -> tuple:
+            return self._render_stats_inline(await self.get_monthly_stats(user_id), "текущий месяц", "месяц")
 
-    async def _display_stats_inline(self, query, stats: dict, period_name: str, period_type: str) -> None:
+        text, reply_markup = await self._cached_screen('stats_inline', self._current_period("месяц"), user_id, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    def _render_stats_inline(self, stats: UserTotals, period_name: str, period_type: str) -> tuple:
         """Отображение статистики в inline режиме (локализованные даты)"""
-        sales_data = {}
-        if isinstance(stats, dict):
-            sales_data = stats.get('sales', {}) or {}
+        current_date = datetime.now()
+        if period_type == "день":
+            date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
         else:
-            sales_data = {}
+            date_str = format_date(current_date, "LLLL yyyy", locale="ru")
 
-        if not sales_data:
-            current_date = datetime.now()
-            if period_type == "день":
-                date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
-            else:
-                date_str = format_date(current_date, "LLLL yyyy", locale="ru")
+        if not stats.sales:
             message = f"📊 Статистика за {period_name} ({date_str})\n\n📭 Продаж еще нет"
         else:
-            total_sales = 0
             message_lines = []
 
-            sorted_sales = sorted(sales_data.items(), key=lambda x: self.get_display_name(x[0]))
+            sorted_sales = sorted(stats.sales.items(), key=lambda x: self.get_display_name(x[0]))
             for tariff_key, count in sorted_sales:
                 tariff_name = self.get_display_name(tariff_key)
                 message_lines.append(f"• {tariff_name}: {count} продаж")
-                total_sales += count
-
-            current_date = datetime.now()
-            if period_type == "день":
-                date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
-            else:
-                date_str = format_date(current_date, "LLLL yyyy", locale="ru")
 
             message = f"📊 Статистика за {period_name} ({date_str})\n\n" + "\n".join(message_lines)
-            message += f"\n\n📈 Всего за {period_type}: {total_sales} продаж"
+            message += f"\n\n📈 Всего за {period_type}: {stats.total} продаж"
 
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        return message, InlineKeyboardMarkup(keyboard)
 
     async def show_head_daily_stats(self, query) -> None:
         """Показать общую дневную статистику для руководителя"""
-        daily_stats = self.get_daily_stats()
-        await self._display_head_stats_inline(query, daily_stats, "сегодня", "день")
+        async def render() -> tuple:
+            return self._render_head_stats_inline(await self.get_daily_stats(), "сегодня", "день")
+
+        text, reply_markup = await self._cached_screen('head_stats', self._current_period("день"), None, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
     async def show_head_total_stats(self, query) -> None:
         """Показать общую месячную статистику для руководителя"""
-        monthly_stats = self.get_monthly_stats()
-        await self._display_head_stats_inline(query, monthly_stats, "текущий месяц", "месяц")
+        async def render() -> tuple:
+            return self._render_head_stats_inline(await self.get_monthly_stats(), "текущий месяц", "месяц")
+
+        text, reply_markup = await self._cached_screen('head_stats', self._current_period("месяц"), None, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
-    async def _display_head_stats_inline(self, query, stats: dict, period_name: str, period_type: str) -> None:
+    def _render_head_stats_inline(self, stats: PeriodTotals, period_name: str, period_type: str) -> tuple:
         """Отображение статистики руководителя в inline режиме (локализация дат)"""
-        if not stats:
-            current_date = datetime.now()
-            if period_type == "день":
-                date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
-            else:
-                date_str = format_date(current_date, "LLLL yyyy", locale="ru")
+        current_date = datetime.now()
+        if period_type == "день":
+            date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
+        else:
+            date_str = format_date(current_date, "LLLL yyyy", locale="ru")
 
+        if not stats.users:
             message = f"📊 Общая статистика за {period_name} ({date_str})\n\n📭 Продаж еще нет"
         else:
-            total_all_sales = 0
             message_lines = []
 
-            for user_str, user_data in stats.items():
-                manager_name = user_data.get('full_name', 'Неизвестный')
-                manager_total = 0
-                manager_lines = []
-
-                for tariff_key, count in user_data.get('sales', {}).items():
-                    tariff_name = self.get_display_name(tariff_key)
-                    manager_lines.append(f"   • {tariff_name}: {count}")
-                    manager_total += count
-
-                total_all_sales += manager_total
-                message_lines.append(f"👤 {manager_name}: {manager_total} продаж")
-                message_lines.extend(manager_lines)
+            for user in stats.users.values():
+                message_lines.append(f"👤 {user.full_name or 'Неизвестный'}: {user.total} продаж")
+                for tariff_key, count in user.sales.items():
+                    message_lines.append(f"   • {self.get_display_name(tariff_key)}: {count}")
                 message_lines.append("")
 
-            current_date = datetime.now()
-            if period_type == "день":
-                date_str = format_date(current_date, "d MMMM yyyy", locale="ru")
-            else:
-                date_str = format_date(current_date, "LLLL yyyy", locale="ru")
-
             message = f"📊 Общая статистика за {period_name} ({date_str})\n\n" + "\n".join(message_lines)
-            message += f"\n🎯 ОБЩЕЕ КОЛИЧЕСТВО ПРОДАЖ: {total_all_sales}"
+            message += f"\n🎯 ОБЩЕЕ КОЛИЧЕСТВО ПРОДАЖ: {stats.total}"
 
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        return message, InlineKeyboardMarkup(keyboard)
 
     async def show_manage_managers(self, query) -> None:
         """Меню управления менеджерами для руководителя"""
-        monthly_stats = self.get_monthly_stats()
-        managers = []
-
-        for user_str, user_data in monthly_stats.items():
-            full_name = user_data.get('full_name', 'Неизвестный')
-            total_sales = sum(user_data.get('sales', {}).values())
-            managers.append({
-                'id': user_str,
-                'full_name': full_name,
-                'total_sales': total_sales
-            })
+        monthly_stats = await self.get_monthly_stats()
 
         keyboard = []
-        for manager in managers:
-            button_text = f"👤 {manager['full_name']} ({manager['total_sales']} продаж)"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"manager_{manager['id']}")])
+        for user in monthly_stats.users.values():
+            button_text = f"👤 {user.full_name or 'Неизвестный'} ({user.total} продаж)"
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"manager_{user.user_id}")])
 
         keyboard.extend([
             [InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]
@@ -1055,12 +4066,84 @@ class SalesBot:
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("👥 Управление менеджерами:", reply_markup=reply_markup)
 
+    async def _render_leaderboard(self, kind: str, metric: str, user_id: int) -> tuple:
+        """Рейтинг менеджеров и топ тарифов за день/неделю/месяц"""
+        period_names = {'day': 'сегодня', 'week': 'неделю', 'month': 'месяц'}
+        metric_names = {'sales': 'по продажам', 'revenue': 'по доходу'}
+        medals = {1: '🥇', 2: '🥈', 3: '🥉'}
+
+        managers = await self.leaderboard.top(kind, metric)
+        tariffs = await self.leaderboard.top(kind, 'tariffs', 5)
+
+        lines = [f"🏆 Рейтинг за {period_names[kind]} — {metric_names[metric]}\n"]
+        if not managers:
+            lines.append("📭 Продаж еще нет")
+        for place, (user_str, score) in enumerate(managers, start=1):
+            name = self.leaderboard.profiles.get(user_str, ('', ''))[1] or 'Неизвестный'
+            value = f"{score} продаж" if metric == 'sales' else f"{score} ₽"
+            lines.append(f"{medals.get(place, f'{place}.')} {name}: {value}")
+
+        if tariffs:
+            lines.append("\n📦 Топ тарифов:")
+            for place, (tariff_key, count) in enumerate(tariffs, start=1):
+                lines.append(f"{place}. {self.get_display_name(tariff_key)}: {count}")
+
+        user_data = await self.get_session(user_id)
+        if user_data['role'] != 'head':
+            place, members = await self.leaderboard.rank(kind, metric, str(user_id))
+            lines.append(f"\n📍 Ваше место: {place} из {members}" if place else "\n📍 Вы пока не в рейтинге")
+
+        def mark(title: str, active: bool) -> str:
+            return f"• {title} •" if active else title
+
+        keyboard = [
+            [InlineKeyboardButton(mark("День", kind == 'day'), callback_data=f"top_day_{metric}"),
+             InlineKeyboardButton(mark("Неделя", kind == 'week'), callback_data=f"top_week_{metric}"),
+             InlineKeyboardButton(mark("Месяц", kind == 'month'), callback_data=f"top_month_{metric}")],
+            [InlineKeyboardButton(mark("По продажам", metric == 'sales'), callback_data=f"top_{kind}_sales"),
+             InlineKeyboardButton(mark("По доходу", metric == 'revenue'), callback_data=f"top_{kind}_revenue")],
+            [InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]
+        ]
+        return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+    async def top_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Команда /top - рейтинг менеджеров за месяц"""
+        user = update.effective_user
+        if not user:
+            return
+
+        user_id = user.id
+        if not await self.get_session(user_id):
+            await update.message.reply_text("❌ Отправьте /start для начала работы")
+            return
+
+        text, reply_markup = await self._render_leaderboard('month', 'sales', user_id)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+    async def show_leaderboard(self, query, view: str, user_id: int) -> None:
+        """Показать рейтинг из callback 'top_<day|week|month>_<sales|revenue>'"""
+        kind, _, metric = view.partition('_')
+        if kind not in Leaderboard.PERIODS or metric not in ('sales', 'revenue'):
+            await query.edit_message_text("❌ Неизвестный рейтинг")
+            return
+
+        text, reply_markup = await self._render_leaderboard(kind, metric, user_id)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
     async def show_reset_options(self, query, manager_id: str | None = None) -> None:
         """Показать опции сброса статистики"""
         if manager_id:
             try:
                 manager_id_int = int(manager_id)
-                manager_data = self.sales_data.get(manager_id_int)
+                manager_data = await self.sessions.get(manager_id_int)
+                if not manager_data:
+                    # Менеджер из списка мог ещё не отправить /start после обновления:
+                    # имя берётся из статистики месяца, по которой построен список
+                    manager_totals = (await self.get_monthly_stats()).users.get(str(manager_id_int))
+                    if manager_totals:
+                        manager_data = {'username': manager_totals.username,
+                                        'full_name': manager_totals.full_name or manager_totals.username
+                                        or 'Неизвестный'}
                 if manager_data:
                     message = f"🔄 Сброс статистики для {manager_data['full_name']}\n\n"
                     keyboard = [
@@ -1085,89 +4168,64 @@ class SalesBot:
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(message, reply_markup=reply_markup)
 
-    def reset_daily_stats(self, manager_id: str | None = None) -> None:
+    async def reset_daily_stats(self, manager_id: str | None = None) -> None:
         """Сброс дневной статистики"""
-        today = date.today().isoformat()
-        filename = f'data/daily/sales_{today}.json'
-        self._reset_stats_file(filename, manager_id)
-
-    def reset_monthly_stats(self, manager_id: str | None = None) -> None:
-        """Сброс месячной статистики"""
-        current_month = datetime.now().strftime('%Y-%m')
-        filename = f'data/monthly/sales_{current_month}.json'
-        self._reset_stats_file(filename, manager_id)
-
-    def _reset_stats_file(self, filename: str, manager_id: str | None) -> None:
-        """Общая функция сброса статистики"""
-        if not os.path.exists(filename):
-            return
-
-        if manager_id == "all" or not manager_id:
-            os.remove(filename)
-        else:
-            try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                if manager_id in data:
-                    data[manager_id]['sales'] = {}
+        await self._append_reset_event(manager_id)
 
-                with open(filename, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-            except Exception as e:
-                logger.error(f"Ошибка сброса статистики: {e}")
+    async def reset_monthly_stats(self, manager_id: str | None = None) -> None:
+        """Сброс месячной статистики — сброс всех дней текущего месяца"""
+        today = date.today()
+        month_days = [day for day in await self.get_available_days()
+                      if day.strftime('%Y-%m') == today.strftime('%Y-%m') and day != today]
+        await asyncio.gather(*(self._append_reset_event(manager_id, day) for day in month_days + [today]))
 
     async def show_calculator(self, query, user_id: int) -> None:
         """Показать калькулятор доходов (дата локализована)"""
-        user_data = self.sales_data.get(user_id, {})
-        role = user_data.get('role', 'manager')
+        user_data = await self.get_session(user_id) or {}
+        stats_user = None if user_data.get('role', 'manager') == 'head' else user_id
+
+        async def render() -> tuple:
+            return self._render_calculator(await self.get_monthly_stats(stats_user), stats_user is None)
 
+        text, reply_markup = await self._cached_screen('calculator', self._current_period("месяц"), stats_user, render)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    def _render_calculator(self, monthly_stats: PeriodTotals | UserTotals, for_head: bool) -> tuple:
         month_title = format_date(datetime.now(), 'LLLL yyyy', locale='ru')
 
-        if role == 'head':
-            monthly_stats = self.get_monthly_stats()
-            if not monthly_stats:
+        if for_head:
+            if not monthly_stats.users:
                 message = f"🧮 Калькулятор: данных нет для {month_title}"
             else:
-                total_all = 0
                 message_lines = [f"🧮 Калькулятор дохода — {month_title}\n"]
 
-                for user_str, udata in monthly_stats.items():
-                    manager_total = 0
-                    message_lines.append(f"\n👤 {udata.get('full_name', '—')}:")
-                    for tariff_key, count in udata.get('sales', {}).items():
-                        price = PRICE_MAP.get(tariff_key, 0)
+                for user in monthly_stats.users.values():
+                    message_lines.append(f"\n👤 {user.full_name or '—'}:")
+                    for tariff_key, count in user.sales.items():
+                        price = TARIFF_CATALOG.price(tariff_key)
                         subtotal = price * count
-                        manager_total += subtotal
                         message_lines.append(f"   • {self.get_display_name(tariff_key)}: {count} × {price} = {subtotal} ₽")
 
-                    message_lines.append(f"   ➜ Всего у менеджера: {manager_total} ₽")
-                    total_all += manager_total
+                    message_lines.append(f"   ➜ Всего у менеджера: {user.revenue} ₽")
 
-                message_lines.append(f"\n🎯 ИТОГО ПО ВСЕМ МЕНЕДЖЕРАМ: {total_all} ₽")
+                message_lines.append(f"\n🎯 ИТОГО ПО ВСЕМ МЕНЕДЖЕРАМ: {monthly_stats.revenue} ₽")
                 message = "\n".join(message_lines)
         else:
-            monthly_stats = self.get_monthly_stats(user_id)
-            sales_data = monthly_stats.get('sales', {}) if monthly_stats else {}
-
-            if not sales_data:
+            if not monthly_stats.sales:
                 message = f"🧮 Калькулятор: у вас нет продаж за {month_title}"
             else:
-                total = 0
                 message_lines = [f"🧮 Калькулятор дохода — {month_title}\n"]
 
-                for tariff_key, count in sales_data.items():
-                    price = PRICE_MAP.get(tariff_key, 0)
+                for tariff_key, count in monthly_stats.sales.items():
+                    price = TARIFF_CATALOG.price(tariff_key)
                     subtotal = price * count
-                    total += subtotal
                     message_lines.append(f"• {self.get_display_name(tariff_key)}: {count} × {price} = {subtotal} ₽")
 
-                message_lines.append(f"\n💰 Итого: {total} ₽")
+                message_lines.append(f"\n💰 Итого: {monthly_stats.revenue} ₽")
                 message = "\n".join(message_lines)
 
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        return message, InlineKeyboardMarkup(keyboard)
 
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик нажатий на кнопок (добавлена обработка новых кнопок)"""
@@ -1175,11 +4233,11 @@ class SalesBot:
         await query.answer()
 
         user_id = query.from_user.id
-        if user_id not in self.sales_data:
+        user_data = await self.get_session(user_id)
+        if not user_data:
             await query.edit_message_text("❌ Сессия устарела. Отправьте /start")
             return
 
-        user_data = self.sales_data[user_id]
         data = query.data
 
         try:
@@ -1205,12 +4263,26 @@ class SalesBot:
             elif data.startswith("month_"):
                 month_str = data[6:]  # Убираем 'month_'
                 await self.show_month_stats(query, month_str, user_id)
+            elif data == "view_range":
+                await self.show_range_menu(query)
+            elif data.startswith("top_"):
+                await self.show_leaderboard(query, data[4:], user_id)
+            elif data.startswith("range_"):
+                await self.show_range_stats(query, data[6:], user_id)
             elif data == "manage_managers":
                 await self.show_manage_managers(query)
             elif data == "reset_stats":
                 await self.show_reset_options(query)
             elif data == "export_data":
-                await self.export_data_from_button(query)
+                await self.show_export_menu(query, user_id)
+            elif data == "expstatus":
+                await self.show_export_status(query, user_id)
+            elif data == "expcancel":
+                await self.cancel_export_from_button(query, user_id)
+            elif data.startswith("expfmt_"):
+                await self.show_export_periods(query, data[7:], user_id)
+            elif data.startswith("exp_"):
+                await self.export_data_from_button(query, data[4:])
             elif data == "calculator":
                 await self.show_calculator(query, user_id)
             elif data.startswith("manager_"):
@@ -1218,22 +4290,16 @@ class SalesBot:
                 await self.show_reset_options(query, manager_id)
             elif data.startswith("reset_daily_"):
                 manager_id = data.split('_')[2] if data != "reset_all_daily" else "all"
-                self.reset_daily_stats(manager_id)
-                await query.edit_message_text("✅ Дневная статистика сброшена")
-                await asyncio.sleep(1)
-                await self.show_main_menu(query, user_id, user_data['role'])
+                await self.reset_daily_stats(manager_id)
+                await self.show_main_menu(query, user_id, user_data['role'], notice="✅ Дневная статистика сброшена")
             elif data.startswith("reset_monthly_"):
                 manager_id = data.split('_')[2] if data != "reset_all_monthly" else "all"
-                self.reset_monthly_stats(manager_id)
-                await query.edit_message_text("✅ Месячная статистика сброшена")
-                await asyncio.sleep(1)
-                await self.show_main_menu(query, user_id, user_data['role'])
+                await self.reset_monthly_stats(manager_id)
+                await self.show_main_menu(query, user_id, user_data['role'], notice="✅ Месячная статистика сброшена")
             elif data.startswith("tariff_"):
                 tariff_key = data[7:]
                 await self.show_tariff_submenu(query, tariff_key)
-            elif data in self._get_all_submenu_keys():
-                await self.record_sale(query, data)
-            elif data in TARIFFS and TARIFFS[data].get('submenu') is None:
+            elif TARIFF_CATALOG.is_recordable(data):
                 await self.record_sale(query, data)
             else:
                 await query.edit_message_text("❌ Неизвестная команда")
@@ -1242,99 +4308,177 @@ class SalesBot:
             logger.error(f"Ошибка в обработчике кнопок: {e}")
             await query.edit_message_text("❌ Произошла ошибка. Попробуйте снова.")
 
-    def _get_all_submenu_keys(self) -> set:
-        """Получить все ключи подменю"""
-        keys = set()
-        for tariff_info in TARIFFS.values():
-            submenu = tariff_info.get('submenu')
-            if submenu:
-                keys.update(submenu.keys())
-        return keys
-
-    async def export_data_from_button(self, query) -> None:
-        """Экспорт данных из кнопки"""
-        user_id = query.from_user.id
-        user_data = self.sales_data[user_id]
-
+    async def show_export_menu(self, query, user_id: int) -> None:
+        """Выбор формата экспорта (только для руководителя)"""
+        user_data = await self.get_session(user_id)
         if user_data['role'] != 'head':
             await query.edit_message_text("❌ Доступ только для руководителя")
             return
 
-        await query.edit_message_text("📊 Подготовка экспорта данных...")
-        report = self._generate_text_report()
+        await query.edit_message_text("📤 Выберите формат экспорта:", reply_markup=self.keyboards.export_formats)
+
+    async def show_export_periods(self, query, fmt: str, user_id: int) -> None:
+        """Выбор периода экспорта в формате fmt"""
+        user_data = await self.get_session(user_id)
+        if user_data['role'] != 'head' or fmt not in EXPORT_FORMATS:
+            await query.edit_message_text("❌ Доступ только для руководителя")
+            return
+
+        await query.edit_message_text(f"📤 Экспорт {fmt.upper()}: выберите период "
+                                      "(свой — командой /export ФОРМАТ С ПО):",
+                                      reply_markup=self.keyboards.export_picker(fmt, date.today()))
+
+    async def _export_period(self, first: str | None = None, last: str | None = None) -> tuple:
+        """Период экспорта: заданный, 'all' — вся история, без дат — текущий месяц"""
+        today = date.today()
+        if first == 'all':
+            days = await self.get_available_days()
+            return (days[-1] if days else today), today
+        if first is None:
+            return today.replace(day=1), today
+        return self._parse_range(first, last, max_days=None)
+
+    @staticmethod
+    def _export_keyboard() -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Статус", callback_data="expstatus"),
+                                      InlineKeyboardButton("⏹ Отменить", callback_data="expcancel")]])
+
+    def _export_progress_text(self, job: ExportJob) -> str:
+        period = f"{job.start.strftime('%d.%m.%Y')} — {job.end.strftime('%d.%m.%Y')}"
+        if job.status == 'queued':
+            return f"🕒 Экспорт {job.fmt.upper()} за {period} в очереди (позиция {self.exports.position(job)})"
+        if job.status == 'running':
+            percent = job.days_done * 100 // job.days_total if job.days_total else 0
+            return (f"⏳ Экспорт {job.fmt.upper()} за {period}: {percent}% "
+                    f"({job.days_done}/{job.days_total} дней, {job.rows} строк)")
+        return f"📤 Экспорт {job.fmt.upper()} за {period}: {job.status}"
+
+    async def _report_export(self, job: ExportJob) -> None:
+        """Обновить сообщение с прогрессом экспорта (вызывается очередью)"""
+        if job.message is not None and job.status == 'running':
+            # Приоритет передаётся только через методы бота: сокращения Message не принимают rate_limit_args
+            await self.application.bot.edit_message_text(
+                self._export_progress_text(job), chat_id=job.message.chat_id, message_id=job.message.message_id,
+                reply_markup=self._export_keyboard(), rate_limit_args=PRIORITY_BULK
+            )
 
-        # Разбиваем на части если сообщение слишком длинное
-        max_length = 4000
-        if len(report) > max_length:
-            parts = [report[i:i+max_length] for i in range(0, len(report), max_length)]
-            for part in parts:
-                await query.message.reply_text(f"```\n{part}\n```", parse_mode='Markdown')
+    async def _finish_export(self, job: ExportJob) -> None:
+        """Отправить готовый файл одним документом или сообщить об отмене/ошибке"""
+        if job.status == 'done':
+            filename = f"sales_{job.start.isoformat()}_{job.end.isoformat()}.{job.fmt}"
+            with open(job.path, 'rb') as document:
+                await self.application.bot.send_document(
+                    chat_id=job.message.chat_id,
+                    document=document,
+                    filename=filename,
+                    caption=(f"📤 Продажи за {job.start.strftime('%d.%m.%Y')} — "
+                             f"{job.end.strftime('%d.%m.%Y')}: {job.rows} строк"),
+                    rate_limit_args=PRIORITY_BULK
+                )
+            await job.message.edit_text("✅ Данные успешно экспортированы")
+        elif job.status == 'cancelled':
+            await job.message.edit_text("⏹ Экспорт отменён")
         else:
-            await query.message.reply_text(f"```\n{report}\n```", parse_mode='Markdown')
+            await job.message.edit_text("❌ Ошибка экспорта. Попробуйте снова.")
+
+    async def _start_export(self, user_id: int, fmt: str, start: date, end: date, message) -> str | None:
+        """Поставить экспорт в очередь; текст ошибки, если у пользователя уже есть задача"""
+        job = ExportJob(user_id, fmt, start, end, message)
+        if not self.exports.submit(job):
+            return "⏳ Предыдущий экспорт ещё выполняется: /export_status, /export_cancel"
+        await message.edit_text(self._export_progress_text(job), reply_markup=self._export_keyboard())
+        return None
+
+    async def export_data_from_button(self, query, spec: str) -> None:
+        """Экспорт данных из кнопки: 'ФОРМАТ_С_ПО' или 'ФОРМАТ_all'"""
+        user_data = await self.get_session(query.from_user.id)
+        if user_data['role'] != 'head':
+            await query.edit_message_text("❌ Доступ только для руководителя")
+            return
 
-        await query.edit_message_text("✅ Данные успешно экспортированы")
+        fmt, _, period = spec.partition('_')
+        try:
+            if fmt not in EXPORT_FORMATS:
+                raise ValueError("❌ Неизвестный формат экспорта")
+            start, end = await self._export_period(*period.split('_'))
+        except (TypeError, ValueError):
+            await query.edit_message_text("❌ Неверные параметры экспорта")
+            return
+
+        error = await self._start_export(query.from_user.id, fmt, start, end, query.message)
+        if error:
+            await query.edit_message_text(error)
 
     async def export_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Экспорт данных через команду /export"""
+        """Экспорт данных через команду /export [csv|jsonl] [gz] [С ПО | all]"""
         user = update.effective_user
         if not user:
             return
 
         user_id = user.id
-        if user_id not in self.sales_data:
+        user_data = await self.get_session(user_id)
+        if not user_data:
             await update.message.reply_text("❌ Отправьте /start для начала работы")
             return
 
-        user_data = self.sales_data[user_id]
         if user_data['role'] != 'head':
             await update.message.reply_text("❌ Доступ только для руководителя")
             return
 
-        await update.message.reply_text("📊 Подготовка экспорта данных...")
-        report = self._generate_text_report()
+        fmt, compress, period = 'csv', False, []
+        for arg in context.args or []:
+            value = arg.lower()
+            if value in ('csv', 'jsonl', 'json'):
+                fmt = 'jsonl' if value == 'json' else value
+            elif value in ('gz', 'gzip'):
+                compress = True
+            else:
+                period.append(arg)
+        if compress:
+            fmt += '.gz'
 
-        max_length = 4000
-        if len(report) > max_length:
-            parts = [report[i:i+max_length] for i in range(0, len(report), max_length)]
-            for part in parts:
-                await update.message.reply_text(f"```\n{part}\n```", parse_mode='Markdown')
-        else:
-            await update.message.reply_text(f"```\n{report}\n```", parse_mode='Markdown')
-
-        await update.message.reply_text("✅ Данные успешно экспортированы")
-
-    def _generate_text_report(self) -> str:
-        """Генерация текстового отчета (твоя логика, формат времени сохранён)"""
-        report_lines = []
-        report_lines.append("=" * 50)
-        report_lines.append("ОТЧЕТ ПО ПРОДАЖАМ")
-        report_lines.append(f"Сгенерирован: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        report_lines.append("=" * 50)
-
-        # Дневная статистика
-        daily_stats = self.get_daily_stats()
-        report_lines.append("\n📊 ДНЕВНАЯ СТАТИСТИКА:")
-        if daily_stats:
-            for user_str, user_data in daily_stats.items():
-                report_lines.append(f"\n👤 {user_data.get('full_name', '—')}:")
-                for tariff_key, count in user_data.get('sales', {}).items():
-                    report_lines.append(f"   • {self.get_display_name(tariff_key)}: {count}")
-        else:
-            report_lines.append("   Нет данных")
-
-        # Месячная статистика
-        monthly_stats = self.get_monthly_stats()
-        report_lines.append("\n📈 МЕСЯЧНАЯ СТАТИСТИКА:")
-        if monthly_stats:
-            for user_str, user_data in monthly_stats.items():
-                total = sum(user_data.get('sales', {}).values())
-                report_lines.append(f"\n👤 {user_data.get('full_name', '—')}: {total} продаж")
-                for tariff_key, count in user_data.get('sales', {}).items():
-                    report_lines.append(f"   • {self.get_display_name(tariff_key)}: {count}")
-        else:
-            report_lines.append("   Нет данных")
+        try:
+            if len(period) not in (0, 2) and period != ['all']:
+                raise ValueError("❌ Использование: /export [csv|jsonl] [gz] [С ПО | all]")
+            start, end = await self._export_period(*period)
+        except ValueError as e:
+            await update.message.reply_text(str(e))
+            return
+
+        message = await update.message.reply_text("📊 Подготовка экспорта данных...")
+        error = await self._start_export(user_id, fmt, start, end, message)
+        if error:
+            await message.edit_text(error)
+
+    async def _export_status_text(self, user_id: int) -> tuple:
+        job = self.exports.active(user_id)
+        if job is None:
+            return "📭 Активного экспорта нет", None
+        return self._export_progress_text(job), self._export_keyboard()
+
+    async def export_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Команда /export_status - состояние фонового экспорта"""
+        user = update.effective_user
+        if not user:
+            return
+        text, reply_markup = await self._export_status_text(user.id)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+    async def export_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Команда /export_cancel - отменить фоновый экспорт"""
+        user = update.effective_user
+        if not user:
+            return
+        job = self.exports.cancel(user.id)
+        await update.message.reply_text("⏹ Экспорт будет отменён" if job else "📭 Активного экспорта нет")
+
+    async def show_export_status(self, query, user_id: int) -> None:
+        text, reply_markup = await self._export_status_text(user_id)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
-        return "\n".join(report_lines)
+    async def cancel_export_from_button(self, query, user_id: int) -> None:
+        job = self.exports.cancel(user_id)
+        await query.edit_message_text("⏹ Экспорт будет отменён" if job else "📭 Активного экспорта нет")
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE = None) -> None:
         """Команда /help — улучшенное оформление"""
@@ -1346,8 +4490,11 @@ class SalesBot:
             "/monthstats - Просмотр статистики по месяцам\n"
             "/days - Просмотр статистики по конкретным дням\n"
             "/months - Просмотр статистики по конкретным месяцам\n"
+            "/range С ПО - Статистика за произвольный период (ДД.ММ.ГГГГ)\n"
+            "/top - Рейтинг менеджеров и тарифов за день, неделю и месяц\n"
             "/report - Общий отчет (только для руководителя)\n"
-            "/export - Экспорт данных (только для руководителя)\n"
+            "/export [csv|jsonl] [gz] [С ПО] - Экспорт файлом (только для руководителя)\n"
+            "/export\\_status, /export\\_cancel - Ход и отмена фонового экспорта\n"
             "/help - Эта справка\n"
             "/id - Показать ваш ID и username\n\n"
             "*ДОСТУПНЫЕ ТАРИФЫ:*\n"
@@ -1361,17 +4508,17 @@ class SalesBot:
             "*📊 СИСТЕМА СТАТИСТИКИ:*\n"
             "- Дневная статистика (автоматически сохраняется)\n"
             "- Месячная статистика (сохраняется долгосрочно)\n"
-            "- Просмотр по дням и месяцам\n"
-            "- Текстовый экспорт для анализа"
+            "- Просмотр по дням, месяцам и за любой период\n"
+            "- Экспорт в CSV/JSONL для анализа"
         )
 
         if isinstance(update, Update):
             await update.message.reply_text(help_text, parse_mode='Markdown')
         else:
-            await update.edit_message_text(help_text, parse_mode='Markdown')
-            await asyncio.sleep(2)
-            await self.show_main_menu(update, update.from_user.id,
-                                      self.sales_data[update.from_user.id]['role'])
+            # Справка остаётся на экране, в меню — кнопкой, а не по таймеру
+            keyboard = [[InlineKeyboardButton("◀️ Главное меню", callback_data="back_to_main")]]
+            await update.edit_message_text(help_text, parse_mode='Markdown',
+                                           reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def get_id(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Команда /id - показать информацию о пользователе"""
@@ -1395,6 +4542,54 @@ class SalesBot:
 
         await update.message.reply_text(message, parse_mode='Markdown')
 
+    async def _feed_update(self, payload: dict) -> None:
+        """Обновление из вебхука — в общую очередь приложения, как при опросе"""
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+
+    async def _run_webhook(self, local: bool = False, port: int = WEBHOOK_PORT) -> None:
+        """Работа через вебхук: встроенный сервер вместо run_polling.
+
+        Запуск и остановка повторяют run_polling, включая post_init и post_shutdown.
+        По SIGINT/SIGTERM сервер перестаёт принимать запросы, принятые
+        обновления дообрабатываются, затем данные сбрасываются на диск.
+        Вебхук регистрируется только при заданном WEBHOOK_URL и при остановке
+        не удаляется, чтобы обновления за время перезапуска дождались бота.
+        Экземпляр на каталог данных один (INSTANCE_LOCK): хранилище однопроцессное.
+        Без WEBHOOK_SECRET режим не запускается. local — локальная проверка:
+        сервер слушает только 127.0.0.1, вебхук не регистрируется, секрет не обязателен.
+        """
+        if not local and not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+            raise ValueError("для режима вебхука нужен WEBHOOK_SECRET: 1–256 символов A-Z, a-z, 0-9, _ и -")
+
+        application = self.application
+        server = WebhookServer(self._feed_update, listen='127.0.0.1' if local else WEBHOOK_LISTEN, port=port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass  # Windows: остаётся KeyboardInterrupt
+
+        await application.initialize()
+        try:
+            await self._post_init(application)
+            if WEBHOOK_URL and not local:
+                await application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                                  allowed_updates=Update.ALL_TYPES)
+                logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL}")
+            await application.start()
+            await server.start()
+            try:
+                await stop.wait()
+            finally:
+                logger.info("⏹️ Остановка: приём обновлений через вебхук прекращён")
+                await server.stop()
+                await application.stop()
+        finally:
+            await application.shutdown()
+            await self._post_shutdown(application)
+
     def run(self) -> None:
         """Запуск бота — красивый баннер, обработка исключений"""
         banner = f"""
@@ -1403,19 +4598,87 @@ class SalesBot:
 🐍  Python: {platform.python_version()}
 📦  python-telegram-bot: {getattr(__import__('telegram'), '__version__', 'unknown')}
 📊  Функции: просмотр по дням/месяцам
+📡  Приём обновлений: {UPDATE_MODE}
 {'=' * 60}
 """
         print(banner)
 
         try:
-            self.application.run_polling()
+            if UPDATE_MODE == 'webhook':
+                asyncio.run(self._run_webhook())
+            else:
+                self.application.run_polling()
         except KeyboardInterrupt:
             logger.info("⏹️ Бот остановлен вручную")
         except Exception as e:
             logger.error(f"❌ Ошибка при запуске бота: {e}")
 
 
+def benchmark_startup(budget_ms: float = STARTUP_BUDGET_MS) -> bool:
+    """Замер холодного старта без подключения к Telegram (python BRBDSA.py --benchmark-startup).
+
+    Загрузка модуля, создание бота, загрузка данных (post_init с миграцией
+    и подготовкой хранилища, первые чтения дня и месяца) и общее время до
+    готовности к приёму обновлений сравниваются с бюджетом.
+    """
+    init_started = time.perf_counter()
+    bot = SalesBot(BOT_TOKEN)
+    init_finished = time.perf_counter()
+
+    async def load_data() -> float:
+        await bot._post_init(bot.application)
+        if bot.migration_task:
+            await bot.migration_task
+        await bot.stats_engine.totals(date.today().isoformat())
+        await bot.stats_engine.totals(date.today().strftime('%Y-%m'))
+        finished = time.perf_counter()
+        await bot._post_shutdown(bot.application)
+        return finished
+
+    data_started = time.perf_counter()
+    ready = asyncio.run(load_data())
+
+    ready_ms = (ready - STARTUP_STARTED) * 1000
+    results = [
+        ("Загрузка модуля", (MODULE_LOADED - STARTUP_STARTED) * 1000),
+        ("Создание бота", (init_finished - init_started) * 1000),
+        ("Загрузка данных", (ready - data_started) * 1000),
+        ("Готовность к приёму обновлений", ready_ms),
+    ]
+    for name, elapsed_ms in results:
+        print(f"{name:<32} {elapsed_ms:9.1f} мс")
+    within_budget = ready_ms <= budget_ms
+    print(f"{'Бюджет':<32} {budget_ms:9.1f} мс — {'OK' if within_budget else 'ПРЕВЫШЕН'}")
+    return within_budget
+
+
+def run_webhook_local(port: int = WEBHOOK_PORT) -> None:
+    """Локальная проверка вебхука без Telegram (python BRBDSA.py --webhook-local [порт]).
+
+    Запускается настоящий бот в режиме вебхука на 127.0.0.1, но с OfflineRequest
+    вместо Bot API: POST записанного JSON обновления проходит через _feed_update
+    и настоящие обработчики, а ответы бота выводятся в лог. Например:
+    curl -X POST -H 'X-Telegram-Bot-Api-Secret-Token: <секрет>' -d @update.json
+    http://127.0.0.1:<порт><путь> (заголовок — если задан WEBHOOK_SECRET)
+    """
+    bot = SalesBot(BOT_TOKEN, request=OfflineRequest())
+    asyncio.run(bot._run_webhook(local=True, port=port))
+
+
+MODULE_LOADED = time.perf_counter()
+
 # Запуск бота
 if __name__ == '__main__':
-    bot = SalesBot(BOT_TOKEN)
-    bot.run()
\ No newline at end of file
+    setup_logging()
+    try:
+        if '--benchmark-startup' in sys.argv[1:]:
+            sys.exit(0 if benchmark_startup() else 1)
+        if '--webhook-local' in sys.argv[1:]:
+            args = sys.argv[sys.argv.index('--webhook-local') + 1:]
+            run_webhook_local(int(args[0]) if args else WEBHOOK_PORT)
+            sys.exit(0)
+        bot = SalesBot(BOT_TOKEN)
+        bot.run()
+    except DataDirLocked as e:
+        logger.error(f"❌ {e}")
+        sys.exit(1)
@@ -0,0 +1,75 @@
+"""Доставка экспорта через настоящий SalesBot без Telegram (транспорт OfflineRequest)."""
+import asyncio
+from datetime import date, datetime
+
+import pytest
+
+pytest.importorskip('telegram')
+
+import BRBDSA  # noqa: E402
+
+CHAT_ID = 1
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """Бот на пустом каталоге данных во временной директории"""
+    monkeypatch.chdir(tmp_path)
+    request = BRBDSA.OfflineRequest()
+    return BRBDSA.SalesBot('1:offline', request=request), request
+
+
+def run_bot(bot: BRBDSA.SalesBot, scenario) -> None:
+    async def run() -> None:
+        await bot.application.initialize()
+        await bot._post_init(bot.application)
+        try:
+            await scenario()
+        finally:
+            await bot.application.shutdown()
+            await bot._post_shutdown(bot.application)
+
+    asyncio.run(run())
+
+
+def calls(request: BRBDSA.OfflineRequest, method: str) -> list:
+    return [params for name, params in request.calls if name == method]
+
+
+def test_report_export_edits_progress_message(bot):
+    bot, request = bot
+
+    async def scenario() -> None:
+        message = await bot.application.bot.send_message(chat_id=CHAT_ID, text="📤 Экспорт")
+        today = date.today()
+        job = BRBDSA.ExportJob(CHAT_ID, 'csv', today.replace(day=1), today, message)
+        job.status = 'running'
+        await bot._report_export(job)
+
+    run_bot(bot, scenario)
+
+    edits = calls(request, 'editMessageText')
+    assert len(edits) == 1
+    assert edits[0]['chat_id'] == CHAT_ID
+    assert edits[0]['text'].startswith("⏳ Экспорт CSV")
+
+
+def test_finished_export_is_sent_as_document(bot):
+    bot, request = bot
+
+    async def scenario() -> None:
+        await bot.writer.submit({'ts': datetime.now().isoformat(), 'type': 'sale', 'user_id': CHAT_ID,
+                                 'tariff': 'mts_super', 'username': 'manager', 'full_name': 'Менеджер'})
+        message = await bot.application.bot.send_message(chat_id=CHAT_ID, text="📤 Экспорт")
+        today = date.today()
+        assert await bot._start_export(CHAT_ID, 'csv', today.replace(day=1), today, message) is None
+        while bot.exports.active(CHAT_ID):
+            await asyncio.sleep(0.05)
+
+    run_bot(bot, scenario)
+
+    documents = calls(request, 'sendDocument')
+    assert len(documents) == 1
+    assert documents[0]['chat_id'] == CHAT_ID
+    assert documents[0]['caption'].endswith(": 1 строк")
+    assert calls(request, 'editMessageText')[-1]['text'] == "✅ Данные успешно экспортированы"